@@ -1,11 +1,11 @@
 import os, sys
-import xml.etree.ElementTree as ET
 import math
 
 from models import environment
-from models import agent
 from models import fleet_environment
 from models import dijkstra
+from models import traffic_lights
+from models import route_solver
 
 def sumo_config():
     os.environ["SUMO_HOME"] = '$SUMO_HOME' # -- change to your path to $SUMO_HOME if necessary
@@ -38,34 +38,10 @@ def tls_from_tllxml(file_name):
         </additionals>
 
     Returns:
-    - tls_data: dictionary of tls data
-        tls_data[tl_id][link_index] = [90]
+    - tls_data (traffic_lights.TrafficLights): tls data, read like a dictionary
+        tls_data[tl_id][link_index][t] = state of the link at second t of the cycle
     """
-    tree = ET.parse(file_name)
-    root = tree.getroot()
-
-    tls_data = {}  # initialise tls_data dict
-
-    for tl in root.findall('.//tlLogic'):  # iterate through all <tlLogic>
-        tl_id = tl.get('id')  # find the id=""
-
-        if tl_id not in tls_data:  # initialise tls_data dict for each key
-            tls_data[tl_id] = {}
-        else:
-            sys.exit(f"Error: {tl_id} duplicated")
-
-
-        for phase in tl.findall('.//phase'):  # iterate through all <phase>
-            duration = phase.get('duration')  # find the duration=""
-            state = phase.get('state')  # find the state=""
-
-            # Make tls_data[tl_id][link_index] = nth char in state repeating duration times
-            for link_index in range(len(state)):
-                if link_index not in tls_data[tl_id]:
-                    tls_data[tl_id][link_index] = []
-                tls_data[tl_id][link_index] += [state[link_index] for _ in range(int(duration))]
-
-    return tls_data
+    return traffic_lights.load_tls(file_name)  # parsed once, then cached next to the file
 
 
 if __name__ == '__main__':
@@ -87,6 +63,15 @@ if __name__ == '__main__':
     evaluation = "time"
     num_demands = 200
     congestion_assigned = []  # Type: ["edge_id", int(minute)] It will be defined randomly if not customised
+    precompute = False  # precompute all-pairs travel times for dispatch, worth it on small networks
+    processes = None  # processes training the routes, None for every core, 1 to train in this process
+    warm_start = False  # start Q-tables from shortest path costs instead of zeros, far fewer episodes
+    warm_radius = 0  # with warm_start, also start from the table of an end node trained before within that many meters
+    goal_conditioned = False  # one Q-table per end node kept across demands, instead of a new agent per demand
+    tl_aware = False  # count traffic light waits in commuting and demand travel times
+    candidate_k = None  # only time the k idle vehicles closest in straight line to a demand, None for the whole fleet
+    dispatch_window = 0  # seconds to buffer the demands for and assign them together, 0 to assign them one by one
+    demand_source = None  # recorded trips to replay (a directory of .npy columns or a .csv), None for random demands
     # ---------------------------
     #
     # ---------------------------
@@ -100,6 +85,11 @@ if __name__ == '__main__':
         congestion_level = "low",
         num_vehicle = num_vehicle,
         num_demands = num_demands,
+        precompute = precompute,
+        tl_aware = tl_aware,
+        candidate_k = candidate_k,
+        dispatch_window = dispatch_window,
+        demand_source = demand_source,
     )
 
     congestion = congestion_assigned if congestion_assigned else fleet_env.get_congestion()
@@ -119,22 +109,59 @@ if __name__ == '__main__':
     demand_node_path = []  # [num_demands], to draw the plot
     demand_edge_path = []  # [num_demands], to draw the plot
 
+    # Generate every demand first, so that their routes can be trained in parallel
+    demands = list(fleet_env.demands)  # num_demands of them, fewer if a trace runs out, so num_demands also bounds the memory a trace takes
+    od_pairs = [(start_node[0], end_node[0]) for _, start_node, end_node in demands]
+    routes = route_solver.solve_routes(network_file, tls, congestion, evaluation, od_pairs, 5000, 5, processes, warm_start, goal_conditioned, warm_radius)  # limit of episodes, threshold to converge
+
+    episodes_lst = [episode for _, _, episode in routes]
+    print(f'-- Episodes to Converge: {sum(episodes_lst)} in total, {round(sum(episodes_lst)/len(episodes_lst), 2)} per demand (warm start: {warm_start}, goal-conditioned: {goal_conditioned})\n')
+
 
-    for _ in range(num_demands):
-        # Get the next demand
-        start_node, end_node = fleet_env.update_demand_queue()
+    # Replay the dispatch in demand order
+    if not dispatch_window:
+        for demand, (node_path, edge_path, _) in zip(demands, routes):
+            # Get the next demand
+            start_node, end_node = fleet_env.update_demand_queue(demand)
 
-        # Decide who to work
-        v_id, commute_time = fleet_env.get_neerest_vehicle(start_node)
+            # Decide who to work
+            v_id, commute_time = fleet_env.get_neerest_vehicle(start_node)
 
-        QLearning_agent = agent.Q_Learning(env, start_node, end_node)
-        node_path, edge_path, _, _ = QLearning_agent.train(5000, 5)  # limit of episodes, threshold to converge
-        working_time = math.ceil(env.get_edge_time(edge_path))
+            working_time = math.ceil(env.get_edge_time(edge_path))
 
-        fleet_env.set_vehicle_working(v_id, commute_time, working_time, end_node)  # it will stop automatically
+            fleet_env.set_vehicle_working(v_id, commute_time, working_time, end_node)  # it will stop automatically
 
-        demand_node_path.append(node_path)
-        demand_edge_path.append(edge_path)
+            demand_node_path.append(node_path)
+            demand_edge_path.append(edge_path)
+
+    # Or buffer the demands of every window and assign them together
+    else:
+        pending = []  # (end_node, node_path, edge_path) in the order of fleet_env.demand_queue
+        window_end = demands[0][0] + dispatch_window if demands else 0
+
+        for i in range(len(demands) + 1):
+            # Dispatch every window that closed before the next demand, and the rest once there are no more
+            while fleet_env.demand_queue and (i == len(demands) or demands[i][0] >= window_end):
+                assignments = fleet_env.dispatch_batch(window_end)
+                for position, v_id, commute_time in assignments:
+                    end_node, node_path, edge_path = pending[position]
+                    working_time = math.ceil(env.get_edge_time(edge_path))
+                    fleet_env.set_vehicle_working(v_id, commute_time, working_time, end_node)
+
+                    demand_node_path.append(node_path)
+                    demand_edge_path.append(edge_path)
+
+                assigned = {position for position, _, _ in assignments}
+                pending = [item for position, item in enumerate(pending) if position not in assigned]
+                window_end += dispatch_window
+
+            if i == len(demands):
+                break
+            while demands[i][0] >= window_end:  # empty windows
+                window_end += dispatch_window
+
+            _, end_node = fleet_env.update_demand_queue(demands[i])
+            pending.append((end_node, routes[i][0], routes[i][1]))
 
 
     # 05 Print result
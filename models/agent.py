@@ -1,8 +1,11 @@
 import numpy as np
 import sys
 import datetime
+from collections import deque, OrderedDict
 
 from utilities import progressbar
+from utilities import episode_log
+from models import dijkstra
 
 class rl_agent():
     def __init__ (self, env, start_node, end_node, learning_rate, discount_factor, reward_lst):
@@ -15,33 +18,133 @@ class rl_agent():
         self.env = env
         self.env.set_start_end(start_node, end_node)  # let the env knows where are the start and end nodes
 
+        # Keep every episode by default, see set_logging()
+        self.log_retention = "all"
+        self.log_size = 10
+        self.log_callback = None
+
+        # Start from an all-zero Q-table by default, see set_warm_start()
+        self.warm_potential = False
+        self.q_cache = None
+
 
 
     # Reset agent
     def reset(self):
-        self.q_table = np.zeros((len(self.env.state_space), len(self.env.action_space)))  # state_space * action_space
-        self.logs = {}  # self.logs[episode] = [node_path, edge_path]
+        self.logs = episode_log.EpisodeLog(self.env.state_space, self.env.edges, self.log_retention, self.log_size, self.log_callback)  # self.logs[episode] = [node_path, edge_path]
+        self.costs = deque()  # time taken by the routes of the last episodes, see record_episode()
+        self.route_costs = OrderedDict()  # tuple(edge_path) -> time taken, only the routes of the last episodes, least recently used first
         self.best_result = 0
 
+        # Everything the steps need, as integer ids: states are indices of env.state_space, edges of env.edges
+        network = self.env.network
+        next_edge, next_state = network.transition_table(len(self.env.action_space))
+        self.next_edge = next_edge.tolist()  # [state][action] -> edge, -1 if the action is not valid
+        self.next_state = next_state.tolist()  # [state][action] -> state, -1 if the action is not valid
+        self.out_degree = np.diff(network.out_ptr).tolist()  # [state] -> number of outgoing edges
+        self.edge_start = network.edge_from.tolist()
+        self.edge_end = network.edge_to.tolist()
+        self.edge_action = network.edge_label.tolist()
+        self.start_state = network.node_index[self.env.start_node]
+        self.end_state = network.node_index[self.env.end_node]
+        self.turns = set()  # (edge, next_edge) taken in the current episode
+
+        self.q_table = self.initial_q_table()  # state_space * action_space
+
+
+    def set_warm_start(self, potential = False, cache = None):
+        """
+        Args:
+        - potential (bool): start the Q-table from the shortest path cost-to-go of the end node, see potential_q_table()
+        - cache (QTableCache): start from the Q-table learned for the same or a nearby end node if there is one,
+            and store the learned Q-table in it once converged
+        A cached table comes first, the one of the same end node then the nearest one within cache.radius,
+        then the potential, then zeros
+        """
+        self.warm_potential = potential
+        self.q_cache = cache
+
+
+    def initial_q_table(self):
+        if self.q_cache is not None:
+            q_table = self.q_cache.get(self.env.network, self.end_state)  # same end node, or nearby if cache.radius > 0
+            if q_table is not None:
+                return np.array(q_table, dtype=np.float64)  # a copy, trained in full precision
+        if self.warm_potential:
+            return self.potential_q_table()
+        return np.zeros((len(self.env.state_space), len(self.env.action_space)))
+
+
+    def potential_q_table(self):
+        """
+        Q(s, a) = -(cost of the edge a takes + cost-to-go of the node it leads to), scaled to [-1, 0],
+        i.e. potential-based shaping with the cost-to-go of a reverse Dijkstra from the end node as the potential.
+        The search only runs over the edges an action can take (a node may have more outgoing edges than actions),
+        so the greedy policy of this table already follows the shortest path the agent can drive, ignoring traffic lights.
+        Invalid actions and the ones that cannot reach the end node get their penalty instead.
+        """
+        weights = np.array(self.env.get_edge_weights())
+        next_edge = np.array(self.next_edge)
+        next_state = np.array(self.next_state)
+
+        takeable = np.zeros(len(weights), dtype=bool)
+        takeable[next_edge[next_edge >= 0]] = True
+        agent_weights = np.where(takeable, weights, np.inf)  # the edges no action maps to cannot be on a route of the agent
+        cost_to_go = np.array(dijkstra.shortest_path_tree(self.env.network, agent_weights.tolist(), self.end_state, reverse = True)[0])
+
+        is_valid = next_edge >= 0
+        cost = np.where(is_valid, weights[next_edge] + cost_to_go[next_state], np.inf)
+        is_reachable = np.isfinite(cost)
+        scale = cost[is_reachable].max() if is_reachable.any() else 1.0
+
+        q_table = np.full(cost.shape, float(self.reward_lst[1]))  # dead_end_reward
+        q_table[is_reachable] = -cost[is_reachable] / max(scale, 1e-9)
+        q_table[~is_valid] = self.reward_lst[0]  # invalid_action_reward
+        return q_table
+
+
+    def store_q_table(self):
+        if self.q_cache is not None:
+            self.q_cache.put(self.end_state, self.q_table)
+
+
+    def set_logging(self, retention = "all", size = 10, callback = None):
+        """
+        Choose which episodes train() keeps in its logs, see utilities.episode_log.EpisodeLog
+
+        Args:
+        - retention (str): "all", "last", "best" or "every"
+        - size (int): how many to keep for "last" and "best", the interval for "every"
+        - callback (function): callback(episode, node_path, edge_path, cost) streamed on every episode
+        """
+        self.log_retention = retention
+        self.log_size = size
+        self.log_callback = callback
+
 
     def act(self):
         pass  # let derived classese define themself
 
 
     def step(self, action, node_path, edge_path):
+        """
+        Args:
+        - action (int)
+        - node_path (list of state id), edge_path (list of edge id): the episode so far
+
+        Returns:
+        - next_edge (int), next_state (int), reward (float), is_terminate (bool)
+        """
         # 0. initialise step
         is_terminate = False
         current_state = node_path[-1]
         current_edge = edge_path[-1] if edge_path else None
 
-        outgoing_edges = self.env.decode_node_to_edges(current_state, direction = 'outgoing')
-
         # 1. Determine reward paramaters
         invalid_action_reward = self.reward_lst[0]
         dead_end_reward = self.reward_lst[1]
         loop_reward = self.reward_lst[2]
         completion_reward = self.reward_lst[3]
-        bonus_reward = self.reward_lst[4]  # = ((self.best_result-current_result)/self.best_result)*100 + 50
         continue_reward = self.reward_lst[5]
 
         # Define the reward
@@ -49,77 +152,147 @@ class rl_agent():
 
 
         # 2. Compute the reward and the next state
+        next_edge = self.next_edge[current_state][action]
+
         # Case 1. Out-Of-Bound Action
-        if action not in self.env.decode_edges_to_actions(outgoing_edges):  # e.g. it may be unable to turn right
+        if next_edge == -1:  # e.g. it may be unable to turn right
             reward += invalid_action_reward
             next_state = current_state
             next_edge = current_edge
 
         # Case 2. Valid Action
         else:
-            next_edge = self.env.decode_edges_action_to_edge(outgoing_edges, action)
-            next_state = self.env.decode_edge_to_node(next_edge, direction = 'end')
+            next_state = self.next_state[current_state][action]
 
             # Case 2-1. End Node
-            if next_state in self.env.end_node:
+            if next_state == self.end_state:
                 reward += completion_reward
                 is_terminate = True
 
-                # check if the route is the shortest distance/time
-                if self.env.evaluation in ("time"):
-                    current_result = self.env.get_edge_time(edge_path + [next_edge]) + self.env.get_tl_offset(edge_path + [next_edge])
-                else:
-                    current_result = self.env.get_edge_distance(edge_path + [next_edge])
-
-                if self.best_result == 0:
-                    self.best_result = current_result
-                elif current_result < self.best_result:
-                    for edge in edge_path:
-                        state_index = self.env.state_space.index(self.env.decode_edge_to_node(edge, direction = 'start'))
-                        action_index = self.env.edge_label[edge]
-                        self.q_table[state_index][action_index] += bonus_reward
-                    self.best_result = current_result
+                self.update_best_result(edge_path + [next_edge])
 
             # Case 2-2. Dead-end Route
-            elif not self.env.decode_node_to_edges(next_state, direction = 'outgoing'):
+            elif not self.out_degree[next_state]:
                 reward += dead_end_reward
                 is_terminate = True
 
-                # Backtrack and find bottleneck
-                for edge in reversed(edge_path):
-                    if len(self.env.decode_node_to_edges(self.env.decode_edge_to_node(edge, direction = 'end'), direction = 'outgoing')) > 1:
-                        break
-
-                    state_index = self.env.state_space.index(self.env.decode_edge_to_node(edge, direction = 'start'))
-                    action_index = self.env.edge_label[edge]
-                    self.q_table[state_index][action_index] += dead_end_reward
+                self.backtrack_dead_end(edge_path)
 
             # Case 2-3. Travelling
             elif current_edge != None:
                 # Case 2-4. Travelling in a loop
-                if (current_edge, next_edge) in [(edge_path[i], edge_path[i+1]) for i in range(len(edge_path)-1)]:
+                if (current_edge, next_edge) in self.turns:
                     reward += loop_reward
 
         return next_edge, next_state, reward, is_terminate  # return the next state, reward and is_terminate
 
 
+    # Give a bonus to the route if it is the shortest distance/time so far
+    def update_best_result(self, edge_path):
+        bonus_reward = self.reward_lst[4]  # = ((self.best_result-current_result)/self.best_result)*100 + 50
+
+        if self.env.evaluation in ("time"):
+            current_result = self.get_time(edge_path)
+        else:
+            current_result = self.env.get_edge_distance(self.decode_edge_path(edge_path))
+
+        if self.best_result == 0:
+            self.best_result = current_result
+        elif current_result < self.best_result:
+            for edge in edge_path[:-1]:
+                self.q_table[self.edge_start[edge]][self.edge_action[edge]] += bonus_reward
+            self.best_result = current_result
+
+
+    # Backtrack from a dead end and punish the route up to the bottleneck
+    def backtrack_dead_end(self, edge_path):
+        dead_end_reward = self.reward_lst[1]
+
+        for edge in reversed(edge_path):
+            if self.out_degree[self.edge_end[edge]] > 1:
+                break
+
+            self.q_table[self.edge_start[edge]][self.edge_action[edge]] += dead_end_reward
+
+
     # Update the Q-table
     def learn(self, current_state, action, next_state, reward):
         # 1. Get original Q-value
-        q_predict = self.q_table[self.env.state_space.index(current_state)][action]
+        q_predict = self.q_table[current_state][action]
 
         # 2. Calculate how much Q-value should change
         # ---------------------------------- #
         # Q(S,a) = R + gamma * max(Q(S',a')  #
         # ---------------------------------- #
-        q_target = reward + self.discount_factor * np.max(self.q_table[self.env.state_space.index(next_state)])
+        q_target = reward + self.discount_factor * np.max(self.q_table[next_state])
         # what we need is to find the max one from all q_table[next_state][action]
 
         # 3. Update Q-value practically
         # -------------------------------------------------------------- #
         # Q(S,a) = Q(S,a) + alpha * (R + gamma * max(Q(S',a') - Q(S,a))  #
         # -------------------------------------------------------------- #
-        self.q_table[self.env.state_space.index(current_state)][action] += self.learning_rate * (q_target - q_predict)
+        self.q_table[current_state][action] += self.learning_rate * (q_target - q_predict)
+
+
+    # Translate ids back to the IDs of the env
+    def decode_node_path(self, node_path):
+        return [self.env.state_space[state] for state in node_path]
+
+
+    def decode_edge_path(self, edge_path):
+        return [self.env.edges[edge] for edge in edge_path]
+
+
+    # Time taken by a route, traffic lights included
+    def get_time(self, edge_path):
+        route = tuple(edge_path)
+        if route in self.route_costs:  # converging episodes keep taking the same route
+            self.route_costs.move_to_end(route)
+        else:
+            edge_path = self.decode_edge_path(edge_path)
+            self.route_costs[route] = self.env.get_edge_time(edge_path) + self.env.get_tl_offset(edge_path)
+            if len(self.route_costs) > (self.costs.maxlen or 1) + 1:  # the routes of the convergence window and the current one
+                self.route_costs.popitem(last=False)
+        return self.route_costs[route]
+
+
+    # Keep an episode in the logs, and its time in the ring buffer of the last `threshold` ones
+    def record_episode(self, episode, node_path, edge_path, threshold):
+        if self.costs.maxlen != max(threshold, 1):  # the last one is always kept for print_result()
+            self.costs = deque(maxlen=max(threshold, 1))
+        self.costs.append(self.get_time(edge_path))
+        self.logs.append(episode, node_path, edge_path, self.costs[-1], node_path[-1] == self.end_state)
+
+
+    # Deal with convergence: > threshold to make same results for needed times, and make sure reach the end node
+    def is_converged(self, episode, threshold):
+        if episode <= threshold or not self.logs.is_complete(episode):
+            return False
+
+        # Convergence when time taken in 5 episodes is consistent
+        if len(set(round(cost, 2) for cost in self.costs)) <= 1:
+            return True
+
+        # or when the route takes less than a minute
+        return round(self.costs[-1]/60, 2) < 1
+
+
+    def print_result(self, episode, start_time):
+        end_time = datetime.datetime.now()  # record ending time
+        time_difference = end_time - start_time
+        processing_seconds = time_difference.total_seconds()
+
+        # --- results output ---
+        print('\nTraining Completed...\n')
+        print(f'-- Last Episode: {episode}\n')
+        print(f'-- States: {self.logs[episode][0]}\n')
+        print(f'-- Edges: {self.logs[episode][1]}\n')
+        print(f'-- Processing Time: {processing_seconds} seconds')
+
+        if self.env.evaluation in ("time"):
+            print(f'-- Travelled Time: {round(self.costs[-1]/60, 2)} mins')
+        else:
+            print(f'-- Travelled Distance: {round(self.env.get_edge_distance(self.logs[episode][1]), 2)} m')
 
 
     # Main function implemented
@@ -136,14 +309,15 @@ class rl_agent():
             episode_bar.print()
 
             # Initialise state
-            node_path = [self.env.start_node]
+            node_path = [self.start_state]
             edge_path = []
             is_terminate = False
+            self.turns = set()
 
             # Iterate until reach the assigned terminate
             while True:
                 last_state = node_path[-1]
-                if is_terminate or last_state in self.env.end_node:
+                if is_terminate or last_state == self.end_state:
                     break
 
                 # Decide the action
@@ -157,59 +331,20 @@ class rl_agent():
 
                 # Update state
                 if last_state != next_state:  # last_state == next_state only if the action is not valid
+                    if edge_path:
+                        self.turns.add((edge_path[-1], next_edge))
                     edge_path.append(next_edge)
                     node_path.append(next_state)
 
             # Append to logs
-            self.logs[episode] = [node_path, edge_path]
-
-            # Deal with convergence: > threshold to make same results for needed times, and make sure reach the end node
-            if episode > threshold and self.logs[episode][0][-1] == self.env.end_node:
-
-                # Convergence when time taken in 5 episodes is consistent
-                threshold_lst = []
-                for i in range(threshold):
-                    threshold_lst.append(round(self.env.get_edge_time(self.logs[episode-i][1]) + self.env.get_tl_offset(self.logs[episode-i][1]), 2))
-
-                if all(x == threshold_lst[0] for x in threshold_lst):
-                    end_time = datetime.datetime.now()  # record ending time
-                    time_difference = end_time - start_time
-                    processing_seconds = time_difference.total_seconds()
-
-                    # --- results output ---
-                    print('\nTraining Completed...\n')
-                    print(f'-- Last Episode: {episode}\n')
-                    print(f'-- States: {self.logs[episode][0]}\n')
-                    print(f'-- Edges: {self.logs[episode][1]}\n')
-                    print(f'-- Processing Time: {processing_seconds} seconds')
-
-                    if self.env.evaluation in ("time"):
-                        print(f'-- Travelled Time: {round((self.env.get_edge_time(self.logs[episode][1]) + self.env.get_tl_offset(self.logs[episode][1]))/60, 2)} mins')
-                    else:
-                        print(f'-- Travelled Distance: {round(self.env.get_edge_distance(self.logs[episode][1]), 2)} m')
-
-                    return self.logs[episode][0], self.logs[episode][1], episode, self.logs
-
-                elif round((self.env.get_edge_time(self.logs[episode][1]) + self.env.get_tl_offset(self.logs[episode][1]))/60, 2) < 1:
-                    end_time = datetime.datetime.now()  # record ending time
-                    time_difference = end_time - start_time
-                    processing_seconds = time_difference.total_seconds()
-
-                    # --- results output ---
-                    print('\nTraining Completed...\n')
-                    print(f'-- Last Episode: {episode}\n')
-                    print(f'-- States: {self.logs[episode][0]}\n')
-                    print(f'-- Edges: {self.logs[episode][1]}\n')
-                    print(f'-- Processing Time: {processing_seconds} seconds')
-
-                    if self.env.evaluation in ("time"):
-                        print(f'-- Travelled Time: {round((self.env.get_edge_time(self.logs[episode][1]) + self.env.get_tl_offset(self.logs[episode][1]))/60, 2)} mins')
-                    else:
-                        print(f'-- Travelled Distance: {round(self.env.get_edge_distance(self.logs[episode][1]), 2)} m')
-
-                    return self.logs[episode][0], self.logs[episode][1], episode, self.logs
-
+            self.record_episode(episode, node_path, edge_path, threshold)
 
+            # Deal with convergence
+            if self.is_converged(episode, threshold):
+                self.print_result(episode, start_time)
+                self.store_q_table()
+                node_path, edge_path = self.logs[episode]
+                return node_path, edge_path, episode, self.logs
 
             # Deal with the case that it is unable to converge
             if episode+1 == num_episodes:
@@ -254,35 +389,132 @@ class Q_Learning(rl_agent):
 
     def act(self, state):
         # Choose action with highest Q-value
-        state_index = self.env.state_space.index(state)
-        action = np.argmax(self.q_table[state_index])
+        action = np.argmax(self.q_table[state])
         return action
 
 
-class SARSA(rl_agent):
-    def __init__ (self, env, start_node, end_node):
+class QTableCache:
+    def __init__ (self, max_tables = 64, radius = 0, max_memory = None, dtype = np.float64):
+        """
+        Q-tables learned by earlier agents, keyed by their end node, to warm start later agents
+        going to the same or a nearby end node
+
+        Args:
+        - max_tables (int): the least recently used tables are dropped beyond it, None for no limit
+        - radius (float): straight line distance (m) within which an end node counts as nearby, 0 for the same one only
+        - max_memory (int): bytes the tables may take, the least recently used ones are dropped beyond it
+        - dtype: precision the tables are stored in, e.g. np.float32 to keep twice as many
+        """
+        self.max_tables = max_tables
+        self.radius = radius
+        self.max_memory = max_memory
+        self.dtype = dtype
+        self.tables = OrderedDict()  # end_state -> q_table
+        self.memory = 0  # bytes taken by the tables
 
-        # --------------------------
-        # Hyperparameters
-        # --------------------------
-        learning_rate = 0.9  # alpha
-        discount_factor = 0.1  # gamma
-        exploration_rate = 0.05  # ratio of exploration and exploitation
-        reward_lst = [-100, -100, -100, 10, 100, -1]  # similar to Q_Learning one
-        # --------------------------
-        #
-        # --------------------------
 
-        super().__init__(env, start_node, end_node, learning_rate, discount_factor, reward_lst)
-        self.exploration_rate = exploration_rate
+    def get(self, network, end_state, nearby = True):
+        """
+        Args:
+        - network (CompiledNetwork): where the end nodes are
+        - end_state (int)
+        - nearby (bool): False to only take the table of end_state itself
 
+        Returns:
+        - q_table (np.ndarray) learned for end_state or the nearest cached end node within radius, None if none
+        """
+        if end_state not in self.tables and nearby and self.radius > 0 and self.tables:
+            cached = list(self.tables)
+            distance = np.hypot(*(network.node_xy[cached] - network.node_xy[end_state]).T)
+            if distance.min() <= self.radius:
+                end_state = cached[int(np.argmin(distance))]
+
+        if end_state not in self.tables:
+            return None
+        self.tables.move_to_end(end_state)
+        return self.tables[end_state]
+
+
+    def put(self, end_state, q_table):
+        if end_state in self.tables:
+            self.memory -= self.tables[end_state].nbytes
+        self.tables[end_state] = np.array(q_table, dtype=self.dtype)  # a copy, the agent may keep training on its own
+        self.tables.move_to_end(end_state)
+        self.memory += self.tables[end_state].nbytes
+
+        while len(self.tables) > 1 and (
+            (self.max_tables is not None and len(self.tables) > self.max_tables) or
+            (self.max_memory is not None and self.memory > self.max_memory)
+        ):
+            _, table = self.tables.popitem(last = False)
+            self.memory -= table.nbytes
+
+
+class Goal_Q_Learning():
+    def __init__ (self, env, max_memory = 256 * 2**20, potential = False):
+        """
+        Goal-conditioned Q_Learning: one Q-table per end node rather than per (start, end) pair, kept across demands.
+        A demand going to an end node seen before is answered by a greedy rollout of its table, and it is only
+        trained (further, from that table) when the rollout does not reach the end node from the new start.
+
+        Args:
+        - env (environment.traffic_env)
+        - max_memory (int): bytes the tables may take, they are kept in float32 and the least recently used
+            end nodes are dropped beyond it
+        - potential (bool): start the table of a new end node from the shortest path potentials, see rl_agent.set_warm_start()
+        """
+        self.env = env
+        self.potential = potential
+        self.q_cache = QTableCache(max_tables = None, max_memory = max_memory, dtype = np.float32)
+        self.next_edge, self.next_state = env.network.transition_table(len(env.action_space))
+        self.out_degree = np.diff(env.network.out_ptr)
 
-    def act(self, state):
-        if np.random.random() < self.exploration_rate:
-            # Exploration
-            action = np.random.choice(len(self.env.action_space))
-        else:
-            # Exploitation
-            state_index = self.env.state_space.index(state)
-            action = np.argmax(self.q_table[state_index])
-        return action
+
+    def rollout(self, q_table, start_state, end_state):
+        """
+        Follow the highest Q-value from start_state
+
+        Returns:
+        - node_path (list of state id), edge_path (list of edge id), None if it does not reach end_state
+            without an invalid action, a dead end or coming back to a node
+        """
+        node_path, edge_path = [start_state], []
+        visited = {start_state}
+
+        while node_path[-1] != end_state:
+            state = node_path[-1]
+            action = int(np.argmax(q_table[state]))
+            next_edge = int(self.next_edge[state, action])
+            if next_edge == -1:
+                return None
+
+            next_state = int(self.next_state[state, action])
+            if next_state in visited or (next_state != end_state and not self.out_degree[next_state]):
+                return None
+
+            visited.add(next_state)
+            node_path.append(next_state)
+            edge_path.append(next_edge)
+
+        return node_path, edge_path
+
+
+    def route(self, start_node, end_node, num_episodes, threshold):
+        """
+        Returns:
+        - node_path (list of str), edge_path (list of str)
+        - episode (int): episodes trained for this demand, 0 if it was a rollout
+        """
+        start_state = self.env.network.node_index[start_node]
+        end_state = self.env.network.node_index[end_node]
+
+        q_table = self.q_cache.get(self.env.network, end_state, nearby = False)
+        if q_table is not None:
+            route = self.rollout(q_table, start_state, end_state)
+            if route is not None:
+                return [self.env.state_space[state] for state in route[0]], [self.env.edges[edge] for edge in route[1]], 0
+
+        QLearning_agent = Q_Learning(self.env, start_node, end_node)
+        QLearning_agent.set_warm_start(potential = self.potential, cache = self.q_cache)  # from its table if it has one
+        node_path, edge_path, episode, _ = QLearning_agent.train(num_episodes, threshold)  # stores the table once converged
+        return node_path, edge_path, episode
@@ -0,0 +1,163 @@
+import sys
+import numpy as np
+
+
+def solve(cost, method = "auto", auction_size = 300):
+    """
+    Minimum cost assignment of the rows of cost to its columns, every row or every column being matched
+
+    Args:
+    - cost (np.ndarray[R, C] of float): inf where a row cannot take a column
+    - method (str): "hungarian", "auction", or "auto" for the Hungarian algorithm up to auction_size rows and columns
+    - auction_size (int)
+
+    Returns:
+    - row_ind (np.ndarray[min(R, C)] of int), col_ind (np.ndarray[min(R, C)] of int):
+        row row_ind[k] takes column col_ind[k], sorted by row
+    """
+    if method == "auto":
+        method = "hungarian" if max(np.shape(cost)) <= auction_size else "auction"
+
+    if method == "hungarian":
+        return hungarian(cost)
+    elif method == "auction":
+        return auction(cost)
+    else:
+        sys.exit(f'Error: Invalid assignment method {method}')
+
+
+def finite_cost(cost):
+    """
+    Replace inf by a cost higher than any assignment made of finite entries,
+    so that an infeasible pair is only taken when nothing else is left
+
+    Returns:
+    - cost (np.ndarray[R, C] of float)
+    """
+    cost = np.asarray(cost, dtype=np.float64)
+    finite = np.isfinite(cost)
+    if finite.all():
+        return cost.copy()
+    scale = np.abs(cost[finite]).max() if finite.any() else 0.0
+    return np.where(finite, cost, (scale + 1) * (min(cost.shape) + 1))
+
+
+def hungarian(cost):
+    """
+    Hungarian algorithm with potentials (shortest augmenting paths), O(R^2 C) for R <= C,
+    the scan over the columns of every step in numpy
+
+    Args / Returns: see solve()
+    """
+    cost = finite_cost(cost)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    rows, cols = cost.shape
+
+    # 1-based like the textbook version, column 0 is the virtual start of every augmenting path
+    u = np.zeros(rows + 1)  # potential of every row
+    v = np.zeros(cols + 1)  # potential of every column
+    match = np.zeros(cols + 1, dtype=np.int64)  # row matched to every column, 0 if none
+    way = np.zeros(cols + 1, dtype=np.int64)  # previous column on the augmenting path
+
+    for row in range(1, rows + 1):
+        match[0] = row
+        column = 0
+        min_reduced = np.full(cols + 1, np.inf)
+        used = np.zeros(cols + 1, dtype=bool)
+
+        # 1. Grow the alternating tree until it reaches a free column
+        while True:
+            used[column] = True
+            reduced = cost[match[column] - 1] - u[match[column]] - v[1:]
+            better = ~used[1:] & (reduced < min_reduced[1:])
+            min_reduced[1:][better] = reduced[better]
+            way[1:][better] = column
+
+            candidates = np.where(used[1:], np.inf, min_reduced[1:])
+            next_column = int(np.argmin(candidates)) + 1
+            delta = candidates[next_column - 1]
+
+            u[match[used]] += delta
+            v[used] -= delta
+            min_reduced[~used] -= delta
+
+            column = next_column
+            if match[column] == 0:
+                break
+
+        # 2. Flip the path
+        while column:
+            previous = way[column]
+            match[column] = match[previous]
+            column = previous
+
+    col_ind = np.flatnonzero(match[1:])
+    row_ind = match[1:][col_ind] - 1
+    if transposed:
+        row_ind, col_ind = col_ind, row_ind
+    order = np.argsort(row_ind)
+    return row_ind[order], col_ind[order]
+
+
+def auction(cost, epsilon = None):
+    """
+    Auction algorithm with epsilon scaling, every unassigned row bidding at once on its best column.
+    The result is within min(R, C) * epsilon of the optimum, exact for integer costs with the default epsilon.
+
+    Args:
+    - cost (np.ndarray[R, C] of float)
+    - epsilon (float): final bid increment, defaults to 1 / (min(R, C) + 1)
+
+    Returns: see solve()
+    """
+    cost = finite_cost(cost)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    rows, cols = cost.shape
+
+    # square it with rows that value every column the same, so that a column left free costs nothing
+    benefit = np.zeros((cols, cols))
+    benefit[:rows] = -cost
+    final_epsilon = epsilon or 1 / (rows + 1)
+    epsilon = max(np.ptp(benefit) / 4, final_epsilon)
+
+    prices = np.zeros(cols)
+    while True:
+        owner = np.full(cols, -1)  # row holding every column
+        assigned = np.full(cols, -1)  # column held by every row
+
+        while (assigned < 0).any():
+            bidders = np.flatnonzero(assigned < 0)
+            values = benefit[bidders] - prices
+            best = np.argmax(values, axis=1)
+            first = values[np.arange(len(bidders)), best]
+            values[np.arange(len(bidders)), best] = -np.inf
+            second = values.max(axis=1) if cols > 1 else first
+            bids = prices[best] + first - second + epsilon
+
+            # every column goes to its highest bid, the first bidder on a tie
+            top = np.full(cols, -np.inf)
+            np.maximum.at(top, best, bids)
+            winning = np.flatnonzero(bids == top[best])
+            won, first_winner = np.unique(best[winning], return_index=True)
+            winners = bidders[winning[first_winner]]
+
+            losers = owner[won]
+            assigned[losers[losers >= 0]] = -1
+            owner[won] = winners
+            assigned[winners] = won
+            prices[won] = top[won]
+
+        if epsilon <= final_epsilon:
+            break
+        epsilon = max(epsilon / 4, final_epsilon)
+
+    row_ind = np.arange(rows)
+    col_ind = assigned[:rows]
+    if transposed:
+        row_ind, col_ind = col_ind, row_ind
+    order = np.argsort(row_ind)
+    return row_ind[order], col_ind[order]
@@ -0,0 +1,271 @@
+import heapq
+import numpy as np
+
+from utilities import filecache
+
+
+_hierarchies = {}  # network_file -> ContractionHierarchy
+
+
+def load(network):
+    """
+    Return the contraction hierarchy of a compiled network, built once and cached on disk next to the network file
+
+    Args:
+    - network (CompiledNetwork)
+
+    Returns:
+    - hierarchy (ContractionHierarchy)
+    """
+    if network.network_file not in _hierarchies:
+        arrays = filecache.load(network.network_file, 'ch')
+        if arrays is None or len(arrays['rank']) != len(network.nodes):
+            arrays = contract(network)
+            filecache.save(network.network_file, 'ch', arrays)
+        _hierarchies[network.network_file] = ContractionHierarchy(network, arrays)
+    return _hierarchies[network.network_file]
+
+
+def contract(network):
+    """
+    Order the nodes by minimum degree and contract them one after another, connecting all the
+    remaining neighbours of every contracted node. No witness search is done, so the shortcuts
+    do not depend on the edge weights and any metric can be customised on top of them later.
+
+    Args:
+    - network (CompiledNetwork)
+
+    Returns:
+    - arrays (dict):
+        rank[N]: contraction order of every node
+        up_ptr[N+1], up_head[A]: arcs from node v to its higher ranked neighbours up_head[up_ptr[v]:up_ptr[v+1]]
+    """
+    num_nodes = len(network.nodes)
+
+    # 01 Undirected graph without self loops, the direction is only dealt with by the metric
+    neighbours = [set() for _ in range(num_nodes)]
+    for start, end in zip(network.edge_from.tolist(), network.edge_to.tolist()):
+        if start != end:
+            neighbours[start].add(end)
+            neighbours[end].add(start)
+
+    # 02 Contract the node of minimum degree, the heap is refreshed lazily
+    rank = [-1] * num_nodes
+    upward = [None] * num_nodes
+    priority_queue = [(len(neighbours[node]), node) for node in range(num_nodes)]
+    heapq.heapify(priority_queue)
+
+    for order in range(num_nodes):
+        while True:
+            degree, node = heapq.heappop(priority_queue)
+            if rank[node] == -1 and degree == len(neighbours[node]):
+                break
+
+        rank[node] = order
+        upward[node] = sorted(neighbours[node])
+
+        for neighbour in upward[node]:
+            neighbours[neighbour].discard(node)
+            neighbours[neighbour].update(other for other in upward[node] if other != neighbour)
+        for neighbour in upward[node]:
+            heapq.heappush(priority_queue, (len(neighbours[neighbour]), neighbour))
+        neighbours[node] = set()
+
+    up_ptr = [0]
+    up_head = []
+    for node in range(num_nodes):
+        up_head += upward[node]
+        up_ptr.append(len(up_head))
+
+    return {
+        'rank': np.array(rank, dtype=np.int32),
+        'up_ptr': np.array(up_ptr, dtype=np.int32),
+        'up_head': np.array(up_head, dtype=np.int32),
+    }
+
+
+class ContractionHierarchy:
+    def __init__ (self, network, arrays):
+        """
+        Metric independent contraction hierarchy, see contract()
+
+        Args:
+        - network (CompiledNetwork)
+        - arrays (dict): output of contract()
+        """
+        self.network = network
+        self.rank = arrays['rank'].tolist()
+        self.up_ptr = arrays['up_ptr'].tolist()
+        self.up_head = arrays['up_head'].tolist()
+        self.up_tail = [-1] * len(self.up_head)  # the lower node of every arc
+        self.arc_index = {}  # (lower node, higher node) -> arc
+        for node in range(len(self.rank)):
+            for arc in range(self.up_ptr[node], self.up_ptr[node+1]):
+                self.up_tail[arc] = node
+                self.arc_index[(node, self.up_head[arc])] = arc
+        self.metrics = {}  # digest of the weights -> customised metric
+
+
+    def customize(self, weights, digest = None):
+        """
+        Give the arcs their cost for a set of edge weights, e.g. after congestion changed.
+        It only walks the lower triangles of the hierarchy once, much cheaper than contracting again.
+
+        Args:
+        - weights (list[E] of float): cost of each edge
+        - digest (str): filecache.array_digest(weights) if the caller already knows it
+
+        Returns:
+        - metric (dict):
+            up_cost[A], down_cost[A]: cost of arc (v, u) from v up to u, and from u down to v
+            up_middle[A], down_middle[A]: the node the arc is a shortcut over, -1 for an original edge
+            up_edge[A], down_edge[A]: that original edge
+        """
+        key = digest or filecache.array_digest(weights)
+        if key in self.metrics:
+            return self.metrics[key]
+
+        num_arcs = len(self.up_head)
+        up_cost, down_cost = [float('inf')] * num_arcs, [float('inf')] * num_arcs
+        up_middle, down_middle = [-1] * num_arcs, [-1] * num_arcs
+        up_edge, down_edge = [-1] * num_arcs, [-1] * num_arcs
+
+        # 01 Original edges, keep the cheapest one of parallel edges
+        for edge, (start, end) in enumerate(zip(self.network.edge_from.tolist(), self.network.edge_to.tolist())):
+            if start == end:
+                continue
+            if self.rank[start] < self.rank[end]:
+                arc = self.arc_index[(start, end)]
+                if weights[edge] < up_cost[arc]:
+                    up_cost[arc], up_edge[arc] = weights[edge], edge
+            else:
+                arc = self.arc_index[(end, start)]
+                if weights[edge] < down_cost[arc]:
+                    down_cost[arc], down_edge[arc] = weights[edge], edge
+
+        # 02 Lower triangles (v, u, w) with v lowest: u -> v -> w may be cheaper than the arc between u and w
+        for node in sorted(range(len(self.rank)), key=lambda node: self.rank[node]):
+            arcs = range(self.up_ptr[node], self.up_ptr[node+1])
+            for arc_u in arcs:
+                u = self.up_head[arc_u]
+                for arc_w in arcs:
+                    w = self.up_head[arc_w]
+                    if u == w:
+                        continue
+                    cost = down_cost[arc_u] + up_cost[arc_w]  # u -> node -> w
+                    if self.rank[u] < self.rank[w]:
+                        arc = self.arc_index[(u, w)]
+                        if cost < up_cost[arc]:
+                            up_cost[arc], up_middle[arc] = cost, node
+                    else:
+                        arc = self.arc_index[(w, u)]
+                        if cost < down_cost[arc]:
+                            down_cost[arc], down_middle[arc] = cost, node
+
+        self.metrics[key] = {
+            'up_cost': up_cost, 'down_cost': down_cost,
+            'up_middle': up_middle, 'down_middle': down_middle,
+            'up_edge': up_edge, 'down_edge': down_edge,
+        }
+        return self.metrics[key]
+
+
+    def upward_search(self, cost_of_arc, source):
+        """
+        Dijkstra that only climbs to higher ranked nodes
+
+        Returns:
+        - cost (dict): node -> cost, predecessor_arc (dict): node -> arc it was reached by
+        - settled (int): number of nodes settled
+        """
+        cost = {source: 0}
+        predecessor_arc = {source: -1}
+        priority_queue = [(0, source)]
+        settled = 0
+
+        while priority_queue:
+            current_cost, current_node = heapq.heappop(priority_queue)
+            if current_cost > cost[current_node]:
+                continue
+            settled += 1
+
+            for arc in range(self.up_ptr[current_node], self.up_ptr[current_node+1]):
+                adj_node = self.up_head[arc]
+                temp_cost = current_cost + cost_of_arc[arc]
+                if temp_cost < cost.get(adj_node, float('inf')):
+                    cost[adj_node] = temp_cost
+                    predecessor_arc[adj_node] = arc
+                    heapq.heappush(priority_queue, (temp_cost, adj_node))
+
+        return cost, predecessor_arc, settled
+
+
+    def unpack(self, metric, arc, up):
+        """
+        Expand an arc into the original edges it stands for
+
+        Args:
+        - arc (int)
+        - up (bool): True for the direction from the lower node to the higher one
+
+        Returns:
+        - edge_path (list of edge index)
+        """
+        edge_path = []
+        stack = [(arc, up)]
+
+        while stack:
+            arc, up = stack.pop()
+            middle = metric['up_middle'][arc] if up else metric['down_middle'][arc]
+            if middle == -1:
+                edge_path.append(metric['up_edge'][arc] if up else metric['down_edge'][arc])
+                continue
+
+            # arc = (low, high) is a shortcut over middle, which is lower than both of them
+            low, high = self.up_tail[arc], self.up_head[arc]
+            start, end = (low, high) if up else (high, low)
+            # start -> middle goes down the arc (middle, start), middle -> end goes up the arc (middle, end)
+            stack.append((self.arc_index[(middle, end)], True))
+            stack.append((self.arc_index[(middle, start)], False))
+
+        return edge_path
+
+
+    def query(self, metric, source, target):
+        """
+        Bidirectional upward search: forward from source on the up costs, backward from target on the down costs
+
+        Args:
+        - metric (dict): output of customize()
+        - source (int), target (int): node indices
+
+        Returns:
+        - cost (float): inf if target cannot be reached
+        - node_path (list of node index), edge_path (list of edge index): like dijkstra.trace_path()
+        - settled (int): number of nodes settled by both searches
+        """
+        forward_cost, forward_arc, forward_settled = self.upward_search(metric['up_cost'], source)
+        backward_cost, backward_arc, backward_settled = self.upward_search(metric['down_cost'], target)
+        settled = forward_settled + backward_settled
+
+        meeting_node, cost = -1, float('inf')
+        for node, node_cost in forward_cost.items():
+            if node in backward_cost and node_cost + backward_cost[node] < cost:
+                meeting_node, cost = node, node_cost + backward_cost[node]
+
+        if meeting_node == -1:
+            return cost, [target], [], settled
+
+        # source climbs up to meeting_node, then it goes down to target
+        edge_path = []
+        node = meeting_node
+        while forward_arc[node] != -1:
+            edge_path = self.unpack(metric, forward_arc[node], True) + edge_path
+            node = self.up_tail[forward_arc[node]]
+        node = meeting_node
+        while backward_arc[node] != -1:
+            edge_path += self.unpack(metric, backward_arc[node], False)
+            node = self.up_tail[backward_arc[node]]
+
+        node_path = [source] + [int(self.network.edge_to[edge]) for edge in edge_path]
+        return cost, node_path, edge_path, settled
@@ -1,27 +1,50 @@
-import sumolib
+import os
+import sys
+import csv
 import random
+import numpy as np
+from collections import OrderedDict
 
 from models import environment
 from models import dijkstra
+from models import network
 
 class Demand:
-    def __init__(self, network_file, tls, offset=0, num_demands=200):
+    def __init__(self, network_file, tls, offset=0, num_demands=200, precompute=False, tl_aware=False, max_origins=1024):
         self.network_file = network_file
 
-        self.net = sumolib.net.readNet(network_file)  # file -> net
-        self.nodes = [node.getID().upper() for node in self.net.getNodes()]  # net -> nodes (ID)
-        self.edges = [edge.getID() for edge in self.net.getEdges()]  # net -> edges (ID)
+        self.network = network.load(network_file)  # file -> compiled network
+        self.nodes = self.network.nodes  # net -> nodes (ID)
+        self.edges = self.network.edges  # net -> edges (ID)
         self.state_space = self.nodes  # state_space
 
         self.tls = tls
+        self.mock_env = environment.traffic_env(network_file = self.network_file, tls = self.tls, evaluation="time")  # to measure travel time
+        if precompute:
+            self.mock_env.use_travel_table()  # travel times become table lookups
+        self.tl_aware = tl_aware  # count the traffic lights in the travel time
+        self.min_travel_time = 100  # 100 seconds stands for 1.67 minutes
 
-        self.offset = offset  # this is a reserved term for future use with a known dataset
+        self.origin_costs = OrderedDict()  # origin node index -> travel times to every node, least recently used first
+        self.max_origins = max_origins
+        self.rng = None  # numpy generator of push_batch(), seeded from random on first use
+
+        self.offset = offset  # this is a reserved term for future use with a known dataset, see TraceDemand
         self.num_demands = num_demands
         self.current_time = 0
         self.current_demand = 0
 
 
 
+    def __iter__ (self):
+        """
+        Yield the demands one by one, lazily, until num_demands of them were pushed
+        """
+        while self.current_demand < self.num_demands:
+            yield self.push()
+
+
+
     def push (self):
         """
         Push a demand to the environment
@@ -33,8 +56,8 @@ class Demand:
         - end_node (str)
         """
         # Make sure the travel time is not too short, it is necessary to be close to reality
-        travel_time = 0
-        while travel_time < 100:    # 100 seconds stands for 1.67 minutes
+        is_feasible = False
+        while not is_feasible:
             # Randomly generate a demand
             asking_time = self.current_time + random.randint(10, 30)
             start_node = random.choices(self.state_space)
@@ -42,14 +65,296 @@ class Demand:
             while end_node == start_node:
                 end_node = random.choices(self.state_space)
 
-            # Get the travel time
-            mock_env = environment.traffic_env(network_file = self.network_file, tls = self.tls, evaluation="time")
-            mock_agent = dijkstra.Dijkstra(mock_env, start_node[0], end_node[0])  # not a agent actually
-            _, edge_path = mock_agent.search()
-            travel_time = mock_env.get_edge_time(edge_path)
+            is_feasible = self.is_feasible(self.network.node_index[start_node[0]], self.network.node_index[end_node[0]], asking_time)
 
         # Update the current time and demand
         self.current_time = asking_time
         self.current_demand += 1
 
         return [asking_time, start_node, end_node]
+
+
+
+    def push_batch (self, size):
+        """
+        Push size demands at once, sampled and checked as arrays. They follow the same rules as push(),
+        but are drawn from a numpy generator, so they are not the ones push() would have given.
+
+        Args:
+        - size (int)
+
+        Returns:
+        - demands (list[size] of [asking_time, start_node, end_node]): like push()
+        """
+        if self.rng is None:
+            self.rng = np.random.default_rng(random.getrandbits(64))  # follows random.seed()
+
+        if size <= 0:
+            return []
+
+        num_nodes = len(self.nodes)
+        start_lst, end_lst, step_lst = [], [], []
+        current_time = self.current_time  # asking time of the last demand kept
+        remaining = size
+
+        while remaining > 0:
+            # 1. Sample the pairs, end_node != start_node
+            start = self.rng.integers(0, num_nodes, remaining)
+            end = self.rng.integers(0, num_nodes - 1, remaining)
+            end += end >= start
+            step = self.rng.integers(10, 31, remaining)
+
+            # 2. Reject the pairs that are unreachable or too short
+            travel_time = self.travel_times(start, end)
+            keep = np.isfinite(travel_time) & (travel_time >= self.min_travel_time)
+            if self.tl_aware:  # the lights can push a short pair over the floor, which depends on when it is asked
+                undecided = np.isfinite(travel_time) & ~keep
+                last_time = current_time + np.cumsum(step * keep)  # asking time of the last one kept, leaving the undecided ones out
+                added = 0  # steps of the undecided ones kept so far
+                for i in np.flatnonzero(undecided).tolist():
+                    keep[i] = self.is_feasible(int(start[i]), int(end[i]), int(last_time[i]) + added + int(step[i]))
+                    if keep[i]:
+                        added += int(step[i])
+
+            current_time += int(step[keep].sum())
+            start_lst.append(start[keep])
+            end_lst.append(end[keep])
+            step_lst.append(step[keep])
+            remaining -= int(keep.sum())
+
+        asking_time = self.current_time + np.cumsum(np.concatenate(step_lst))
+        demands = [
+            [asking, [self.nodes[start]], [self.nodes[end]]]
+            for asking, start, end in zip(asking_time.tolist(), np.concatenate(start_lst).tolist(), np.concatenate(end_lst).tolist())
+        ]
+
+        self.current_time = int(asking_time[-1])
+        self.current_demand += size
+
+        return demands
+
+
+
+    def is_feasible (self, start, end, asking_time):
+        """
+        Whether the trip from start to end is possible and not shorter than min_travel_time.
+        The time without traffic lights is a lower bound of the one with them, so the time-dependent
+        search only runs for the pairs that are below the floor without them.
+
+        Args:
+        - start (int), end (int): node indices
+        - asking_time (int): when it is asked, for the traffic lights
+
+        Returns:
+        - bool
+        """
+        travel_time = self.get_origin_costs(start)[end]
+        if travel_time >= self.min_travel_time:
+            return travel_time != float('inf')
+
+        if self.tl_aware and travel_time != float('inf'):
+            mock_agent = dijkstra.TimeDependentDijkstra(self.mock_env, self.nodes[start], self.nodes[end], asking_time)
+            _, _, arrival = mock_agent.search()
+            return arrival - asking_time >= self.min_travel_time
+
+        return False
+
+
+
+    def travel_times (self, start, end):
+        """
+        Returns:
+        - travel_time (np.ndarray of float): from every start to every end (node indices), without traffic lights, inf if unreachable
+        """
+        table = dijkstra.travel_table(self.mock_env)
+        if table is not None:
+            return np.asarray(table.cost[start, end], dtype=np.float64)
+
+        travel_time = np.empty(len(start), dtype=np.float64)
+        for origin in np.unique(start).tolist():
+            mask = start == origin
+            travel_time[mask] = self.get_origin_costs(origin)[end[mask]]
+        return travel_time
+
+
+
+    def get_origin_costs (self, origin):
+        """
+        Travel times from origin to every node, from one search kept for the next demands asked there
+
+        Args:
+        - origin (int): node index
+
+        Returns:
+        - cost (np.ndarray[N] of float): inf for the nodes that cannot be reached
+        """
+        table = dijkstra.travel_table(self.mock_env)
+        if table is not None:
+            return table.cost[origin]
+
+        if origin in self.origin_costs:
+            self.origin_costs.move_to_end(origin)
+        else:
+            cost, _, _ = dijkstra.shortest_path_tree(self.network, self.mock_env.get_edge_weights("time"), origin)
+            self.origin_costs[origin] = np.array(cost, dtype=np.float64)
+            if len(self.origin_costs) > self.max_origins:
+                self.origin_costs.popitem(last=False)
+
+        return self.origin_costs[origin]
+
+
+
+class TraceDemand:
+    def __init__(self, network_file, trace_file, offset=None, num_demands=None, chunk_size=65536):
+        """
+        Recorded trips (e.g. Cabspotting) replayed as demands. The trace is read chunk by chunk, so iterating
+        over it takes constant memory whatever its length; whoever collects the demands (main.py trains every
+        route first) holds num_demands of them.
+
+        Args:
+        - network_file (str)
+        - trace_file (str): sorted by time, either a directory of .npy columns (memory-mapped) or a .csv file with a header.
+            The columns are time, then origin, destination (node IDs), or origin_x, origin_y, destination_x, destination_y
+            (coordinates of the network), or origin_lon, origin_lat, destination_lon, destination_lat, snapped to the nearest node.
+            Any other column (e.g. a cab id) is ignored
+        - offset (float): time of the trace that becomes 0, defaults to the first time of the trace
+        - num_demands (int): stop after that many demands, None for the whole trace
+        - chunk_size (int): rows read at once
+        """
+        self.network_file = network_file
+        self.network = network.load(network_file)  # file -> compiled network
+        self.nodes = self.network.nodes  # net -> nodes (ID)
+
+        if not os.path.exists(trace_file):
+            sys.exit(f'Error: Trace {trace_file} not found')
+        self.trace_file = trace_file
+        self.offset = offset
+        self.num_demands = num_demands
+        self.chunk_size = chunk_size
+
+        self.rows = self.read_demands()  # generator over the whole trace
+        self.current_time = 0
+        self.current_demand = 0
+
+
+
+    def __iter__ (self):
+        """
+        Yield the demands one by one, lazily, until the trace or num_demands runs out
+        """
+        while self.num_demands is None or self.current_demand < self.num_demands:
+            demand = next(self.rows, None)
+            if demand is None:
+                return
+            yield self.count(demand)
+
+
+
+    def push (self):
+        """
+        Push the next recorded demand to the environment
+
+        Returns:
+        - asking_time (int)
+        - start_node (str)
+        - end_node (str)
+        """
+        demand = next(self.rows, None) if self.num_demands is None or self.current_demand < self.num_demands else None
+        if demand is None:
+            sys.exit(f'Error: No demand left in {self.trace_file}')
+        return self.count(demand)
+
+
+
+    def count (self, demand):
+        self.current_time = demand[0]
+        self.current_demand += 1
+        return demand
+
+
+
+    def read_demands (self):
+        """
+        Yields:
+        - [asking_time, [start_node], [end_node]]: like Demand.push(), skipping the trips that start and end at the same node
+        """
+        for columns in self.read_chunks():
+            # 1. Nodes, snapped to the nearest one when given as coordinates
+            if 'origin' in columns:
+                start = self.lookup_nodes(columns['origin'])
+                end = self.lookup_nodes(columns['destination'])
+            elif 'origin_x' in columns:
+                start, _ = self.network.locator.nearest_nodes(columns['origin_x'], columns['origin_y'])
+                end, _ = self.network.locator.nearest_nodes(columns['destination_x'], columns['destination_y'])
+            else:
+                start, _ = self.network.locator.nearest_nodes(columns['origin_lon'], columns['origin_lat'], lonlat = True)
+                end, _ = self.network.locator.nearest_nodes(columns['destination_lon'], columns['destination_lat'], lonlat = True)
+
+            # 2. Times, relative to offset
+            times = np.asarray(columns['time'], dtype=np.float64)
+            if self.offset is None:
+                self.offset = float(times[0])
+            asking_time = np.round(times - self.offset).astype(np.int64)
+            if (np.diff(asking_time) < 0).any() or asking_time[0] < self.current_time:
+                sys.exit(f'Error: Trace {self.trace_file} is not sorted by time')
+
+            for asking, start_node, end_node in zip(asking_time.tolist(), start.tolist(), end.tolist()):
+                if start_node != end_node:
+                    yield [asking, [self.nodes[start_node]], [self.nodes[end_node]]]
+
+
+
+    def read_chunks (self):
+        """
+        Yields:
+        - columns (dict): name -> np.ndarray of at most chunk_size rows
+        """
+        # .npy columns: every chunk is copied out of fresh memory maps, so the pages read before are let go
+        if os.path.isdir(self.trace_file):
+            paths = {name[:-4]: os.path.join(self.trace_file, name) for name in os.listdir(self.trace_file) if name.endswith('.npy')}
+            paths = {name: paths[name] for name in self.check_columns(paths)}
+            num_rows = len(np.load(paths['time'], mmap_mode='r'))
+            for start in range(0, num_rows, self.chunk_size):
+                yield {name: np.array(np.load(path, mmap_mode='r')[start:start+self.chunk_size]) for name, path in paths.items()}
+            return
+
+        # csv: parsed chunk_size lines at a time
+        with open(self.trace_file, newline='') as f:
+            reader = csv.reader(f)
+            header = [name.strip() for name in next(reader, [])]
+            needed = {name: header.index(name) for name in self.check_columns(header)}
+            while True:
+                rows = [row for _, row in zip(range(self.chunk_size), reader)]
+                if not rows:
+                    return
+                yield {name: np.array([row[i] for row in rows], dtype=str if name in ('origin', 'destination') else np.float64) for name, i in needed.items()}
+
+
+
+    def check_columns (self, columns):
+        """
+        Returns:
+        - needed (list of str): the columns read_demands() uses, in the order it looks for them
+        """
+        for nodes in (
+            ['origin', 'destination'],
+            ['origin_x', 'origin_y', 'destination_x', 'destination_y'],
+            ['origin_lon', 'origin_lat', 'destination_lon', 'destination_lat']):
+            if 'time' in columns and set(nodes) <= set(columns):
+                return ['time'] + nodes
+        sys.exit(f'Error: Trace {self.trace_file} needs the columns time and origin, destination or their _x, _y or _lon, _lat')
+
+
+
+    def lookup_nodes (self, ids):
+        """
+        Returns:
+        - index (np.ndarray of int): node index of every node ID
+        """
+        index = []
+        for node in ids.tolist():
+            if str(node).upper() not in self.network.node_index:
+                sys.exit(f'Error: Invalid node {node} in {self.trace_file}')
+            index.append(self.network.node_index[str(node).upper()])
+        return np.array(index, dtype=np.int64)
+
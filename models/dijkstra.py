@@ -1,26 +1,394 @@
+import sys
 import heapq
 import datetime
+import numpy as np
+
+from models import contraction
+from models import landmarks
+
+
+def shortest_path_tree(network, weights, source, target = -1, reverse = False, heuristic = None):
+    """
+    Plain Dijkstra over the integer indexed network, or A* when a heuristic is given
+
+    Args:
+    - network (CompiledNetwork)
+    - weights (list[E] of float): cost of each edge
+    - source (int): node index the search starts from
+    - target (int): node index to stop at once it is settled, -1 to settle every reachable node
+    - reverse (bool): search the transposed graph, i.e. costs are *to* source rather than from it
+    - heuristic (list[N] of float): consistent lower bound of the cost from each node to target
+
+    Returns:
+    - cost (list[N] of float): inf for the nodes not reached
+    - predecessor_edge (list[N] of int): the last edge on the best path to each node, -1 if none
+        (the first edge of the path *from* each node when reverse)
+    - settled (int): number of nodes settled
+    """
+    ptr, adjacency, head = network.adjacency_lists(reverse)
+
+    cost = [float('inf')] * (len(ptr) - 1)
+    predecessor_edge = [-1] * len(cost)
+    cost[source] = 0
+    priority_queue = [(heuristic[source] if heuristic else 0, 0, source)]
+    settled = 0
+
+    while priority_queue:
+        _, current_cost, current_node = heapq.heappop(priority_queue)  # get the minimum one from the heap
+
+        if current_cost > cost[current_node]:  # stale entry, the node was settled with a lower cost
+            continue
+        settled += 1
+
+        # If the node is the target node, then stop searching
+        if current_node == target:
+            break
+
+        # Explore the neighbors nodes
+        for adj_edge in adjacency[ptr[current_node]:ptr[current_node+1]]:
+            adj_node = head[adj_edge]
+            temp_cost = current_cost + weights[adj_edge]
+
+            # If the tentative distance is less than the current distance of the neighbor
+            if temp_cost < cost[adj_node]:
+                cost[adj_node] = temp_cost
+                predecessor_edge[adj_node] = adj_edge
+                if heuristic:
+                    if heuristic[adj_node] == float('inf'):  # target cannot be reached from there
+                        continue
+                    heapq.heappush(priority_queue, (temp_cost + heuristic[adj_node], temp_cost, adj_node))
+                else:
+                    heapq.heappush(priority_queue, (temp_cost, temp_cost, adj_node))
+
+    return cost, predecessor_edge, settled
+
+
+def bidirectional_search(network, weights, source, target):
+    """
+    Dijkstra from source and, on the transposed graph, from target at the same time,
+    alternating on the smaller queue until the two frontiers cannot improve the best meeting
+
+    Returns:
+    - cost (float): inf if target cannot be reached
+    - node_path (list of node index), edge_path (list of edge index): like trace_path()
+    - settled (int): number of nodes settled by both searches
+    """
+    if source == target:
+        return 0, [source], [], 0
+
+    sides = []
+    for reverse, root in ((False, source), (True, target)):
+        ptr, adjacency, head = network.adjacency_lists(reverse)
+        sides.append({
+            'ptr': ptr, 'adjacency': adjacency, 'head': head,
+            'cost': {root: 0}, 'predecessor_edge': {root: -1}, 'settled': set(),
+            'queue': [(0, root)],
+        })
+
+    best_cost, meeting_node = float('inf'), -1
+
+    while sides[0]['queue'] and sides[1]['queue']:
+        if sides[0]['queue'][0][0] + sides[1]['queue'][0][0] >= best_cost:
+            break
+
+        side, other = (sides[0], sides[1]) if len(sides[0]['queue']) <= len(sides[1]['queue']) else (sides[1], sides[0])
+        current_cost, current_node = heapq.heappop(side['queue'])
+        if current_node in side['settled'] or current_cost > side['cost'][current_node]:
+            continue
+        side['settled'].add(current_node)
+
+        for adj_edge in side['adjacency'][side['ptr'][current_node]:side['ptr'][current_node+1]]:
+            adj_node = side['head'][adj_edge]
+            temp_cost = current_cost + weights[adj_edge]
+
+            if temp_cost < side['cost'].get(adj_node, float('inf')):
+                side['cost'][adj_node] = temp_cost
+                side['predecessor_edge'][adj_node] = adj_edge
+                heapq.heappush(side['queue'], (temp_cost, adj_node))
+
+            if adj_node in other['cost'] and side['cost'][adj_node] + other['cost'][adj_node] < best_cost:
+                best_cost, meeting_node = side['cost'][adj_node] + other['cost'][adj_node], adj_node
+
+    settled = len(sides[0]['settled']) + len(sides[1]['settled'])
+    if meeting_node == -1:
+        return float('inf'), [target], [], settled
+
+    # source -> meeting_node from the forward side, then meeting_node -> target from the backward side
+    node_path, edge_path = trace_path(network, sides[0]['predecessor_edge'], meeting_node)
+    node = meeting_node
+    while sides[1]['predecessor_edge'][node] != -1:
+        edge_path.append(sides[1]['predecessor_edge'][node])
+        node = int(network.edge_to[edge_path[-1]])
+        node_path.append(node)
+
+    return best_cost, node_path, edge_path, settled
+
+
+def euclidean_heuristic(network, target, evaluation):
+    """
+    Straight line lower bound of the cost from every node to target: the straight line (scaled by
+    network.euclidean_factor) for "distance", and the same divided by the maximum speed for "time".
+    Congestion only adds time, so it stays a lower bound.
+
+    Returns:
+    - bound (list[N] of float)
+    """
+    bound = np.hypot(*(network.node_xy - network.node_xy[target]).T) * network.euclidean_factor
+    if evaluation in ("time"):
+        bound /= network.max_speed
+    return bound.tolist()
+
+
+def trace_path(network, predecessor_edge, target):
+    """
+    Walk predecessor_edge back from target
+
+    Returns:
+    - node_path (list of node index), edge_path (list of edge index)
+    """
+    node_path = [target]
+    edge_path = []
+
+    while predecessor_edge[node_path[-1]] != -1:
+        edge_path.append(int(predecessor_edge[node_path[-1]]))
+        node_path.append(int(network.edge_from[edge_path[-1]]))
+
+    node_path.reverse()
+    edge_path.reverse()
+    return node_path, edge_path
+
+
+def time_dependent_search(env, weights, source, target, departure = 0):
+    """
+    Edge-based Dijkstra on arrival times, where turning at a traffic light waits for its link to turn green.
+    The label of an edge is the time its end point is reached; taking the next edge waits the red light
+    of the turn first, read from env.get_turn_wait(). A later arrival never leaves earlier (FIFO) except
+    within the same second, as get_tl_offset() reads the programs by whole seconds, so a route may come out
+    up to a second per traffic light slower than the fastest one.
+    The lights are read on the clock of get_tl_offset(): departure plus the free-flow times and the waits,
+    congestion left out, so the route waits what get_tl_offset() says it does. The arrival still counts the
+    congestion and the last edge, both of which get_edge_time(path) + get_tl_offset(path) leave out:
+    arrival - departure == get_tl_offset(path) + get_edge_time(path) + weights[path[-1]] with departure 0
+    and no congestion.
+
+    Args:
+    - env (environment.traffic_env): provides the network and the traffic light programs
+    - weights (list[E] of float): travel time of each edge, e.g. env.get_edge_weights("time")
+    - source (int), target (int): node indices
+    - departure (float): time the route starts, the traffic lights are in phase with it
+
+    Returns:
+    - arrival (float): time target is reached, inf if it cannot be
+    - node_path (list of node index), edge_path (list of edge index): like trace_path()
+    - settled (int): number of edges settled
+    """
+    if source == target:
+        return departure, [source], [], 0
+
+    ptr, adjacency, head = env.network.adjacency_lists()
+    free_flow = env.network.edge_time
+    arrival = {}  # edge -> time its end point is reached
+    clock = {}  # edge -> the same on the clock of the traffic lights, see above
+    predecessor_edge = {}
+    priority_queue = []
+
+    for edge in adjacency[ptr[source]:ptr[source+1]]:
+        if departure + weights[edge] < arrival.get(edge, float('inf')):
+            arrival[edge] = departure + weights[edge]
+            clock[edge] = departure + free_flow[edge]
+            predecessor_edge[edge] = -1
+            heapq.heappush(priority_queue, (arrival[edge], edge))
+
+    settled = set()
+    while priority_queue:
+        current_time, current_edge = heapq.heappop(priority_queue)
+        if current_edge in settled:
+            continue
+        settled.add(current_edge)
+
+        current_node = head[current_edge]
+        if current_node == target:
+            edge_path = [current_edge]
+            while predecessor_edge[edge_path[-1]] != -1:
+                edge_path.append(predecessor_edge[edge_path[-1]])
+            edge_path.reverse()
+            return current_time, [source] + [head[edge] for edge in edge_path], edge_path, len(settled)
+
+        for adj_edge in adjacency[ptr[current_node]:ptr[current_node+1]]:
+            if adj_edge in settled:
+                continue
+
+            turn = (current_edge, adj_edge)
+            if turn not in env.turn_waits:
+                env.turn_waits[turn] = env.get_turn_wait(*turn)
+            _, wait = env.turn_waits[turn]
+
+            waited = wait[int(clock[current_edge]) % len(wait)] if wait else 0
+            temp_time = current_time + waited + weights[adj_edge]
+            if temp_time < arrival.get(adj_edge, float('inf')):
+                arrival[adj_edge] = temp_time
+                clock[adj_edge] = clock[current_edge] + waited + free_flow[adj_edge]
+                predecessor_edge[adj_edge] = current_edge
+                heapq.heappush(priority_queue, (temp_time, adj_edge))
+
+    return float('inf'), [target], [], len(settled)
+
+
+def travel_table(env, evaluation = None):
+    """
+    The precomputed all-pairs table of env if it matches evaluation, see environment.traffic_env.use_travel_table()
+
+    Returns:
+    - table (travel_table.TravelTable) or None to search on the fly
+    """
+    table = env.travel_table
+    if table is not None and table.evaluation == (evaluation or env.evaluation):
+        return table
+    return None
+
+
+def hierarchy_metric(env, evaluation = None):
+    """
+    The contraction hierarchy of the network of env, customised to its edge weights once per env and evaluation
+
+    Returns:
+    - hierarchy (contraction.ContractionHierarchy), metric (dict): see ContractionHierarchy.customize()
+    """
+    evaluation = evaluation or env.evaluation
+    if ("ch", evaluation) not in env.search_data:
+        hierarchy = contraction.load(env.network)  # the congestion only needs a re-customisation, not a rebuild
+        env.search_data[("ch", evaluation)] = (hierarchy, hierarchy.customize(env.get_edge_weights(evaluation), env.get_weights_digest(evaluation)))
+    return env.search_data[("ch", evaluation)]
+
+
+def alt_landmarks(env, evaluation = None):
+    """
+    The landmark tables of the network of env and its edge weights, looked up once per env and evaluation
+
+    Returns:
+    - landmarks (landmarks.Landmarks)
+    """
+    evaluation = evaluation or env.evaluation
+    if ("alt", evaluation) not in env.search_data:
+        env.search_data[("alt", evaluation)] = landmarks.load(env.network, env.get_edge_weights(evaluation), evaluation, digest = env.get_weights_digest(evaluation))
+    return env.search_data[("alt", evaluation)]
+
+
+def one_to_one(env, source, target, evaluation = None):
+    """
+    Cost from one node to another, in a bidirectional search that stops once the two sides meet
+
+    Args:
+    - env (environment.traffic_env): provides the network and the edge weights
+    - source (str), target (str): node IDs
+    - evaluation (str): "time" or "distance", defaults to env.evaluation
+
+    Returns:
+    - cost (float): inf if target cannot be reached
+    """
+    table = travel_table(env, evaluation)
+    if table is not None:
+        return float(table.cost[env.network.node_index[source], env.network.node_index[target]])
+
+    cost, _, _, _ = bidirectional_search(env.network, env.get_edge_weights(evaluation), env.network.node_index[source], env.network.node_index[target])
+    return cost
+
+
+def one_to_many(env, source, targets, evaluation = None):
+    """
+    Cost from one node to many, in a single forward search
+
+    Args:
+    - env (environment.traffic_env): provides the network and the edge weights
+    - source (str): node ID
+    - targets (list of str): node IDs
+    - evaluation (str): "time" or "distance", defaults to env.evaluation
+
+    Returns:
+    - cost (np.ndarray[len(targets)]): inf for the targets that cannot be reached
+    """
+    table = travel_table(env, evaluation)
+    if table is not None:
+        return np.array(table.cost[env.network.node_index[source], [env.network.node_index[target] for target in targets]], dtype=np.float64)
+
+    cost, _, _ = shortest_path_tree(env.network, env.get_edge_weights(evaluation), env.network.node_index[source])
+    return np.array([cost[env.network.node_index[target]] for target in targets], dtype=np.float64)
+
+
+def many_to_one(env, sources, target, evaluation = None):
+    """
+    Cost from many nodes to one, in a single reverse search from target on the transposed graph
+
+    Args:
+    - env (environment.traffic_env): provides the network and the edge weights
+    - sources (list of str): node IDs, e.g. the positions of the vehicles
+    - target (str): node ID
+    - evaluation (str): "time" or "distance", defaults to env.evaluation
+
+    Returns:
+    - cost (np.ndarray[len(sources)]): inf for the sources that cannot reach target
+    """
+    table = travel_table(env, evaluation)
+    if table is not None:
+        return np.array(table.cost[[env.network.node_index[source] for source in sources], env.network.node_index[target]], dtype=np.float64)
+
+    cost, _, _ = shortest_path_tree(env.network, env.get_edge_weights(evaluation), env.network.node_index[target], reverse = True)
+    return np.array([cost[env.network.node_index[source]] for source in sources], dtype=np.float64)
+
+
+def many_to_many(env, sources, targets, evaluation = None):
+    """
+    Cost matrix between two sets of nodes, with one search per node of the smaller set
+
+    Args:
+    - env (environment.traffic_env): provides the network and the edge weights
+    - sources (list of str): node IDs, e.g. the positions of the vehicles
+    - targets (list of str): node IDs, e.g. the start nodes of the demands
+    - evaluation (str): "time" or "distance", defaults to env.evaluation
+
+    Returns:
+    - cost (np.ndarray[len(sources), len(targets)]): cost[i][j] from sources[i] to targets[j], inf if unreachable
+    """
+    matrix = np.empty((len(sources), len(targets)), dtype=np.float64)
+
+    if len(targets) <= len(sources):
+        for j, target in enumerate(targets):
+            matrix[:, j] = many_to_one(env, sources, target, evaluation)
+    else:
+        for i, source in enumerate(sources):
+            matrix[i, :] = one_to_many(env, source, targets, evaluation)
+
+    return matrix
 
 
 class Dijkstra:
-    def __init__ (self, env, start_node, end_node):
+    def __init__ (self, env, start_node, end_node, method = "dijkstra"):
+        """
+        Args:
+        - env (environment.traffic_env)
+        - start_node (str), end_node (str)
+        - method (str): how to search when env has no travel table
+            - "dijkstra": plain Dijkstra
+            - "astar": A* with the straight line lower bound, see euclidean_heuristic()
+            - "bidirectional": Dijkstra from both ends
+            - "alt": A* with landmark lower bounds, the tables are precomputed and cached, see landmarks.py
+            - "ch": bidirectional query on the contraction hierarchy of the network, see contraction.py
+        The number of nodes settled by the last search() is kept in self.settled
+        """
+        if method not in ("dijkstra", "astar", "bidirectional", "alt", "ch"):
+            sys.exit(f'Error: Invalid search method {method}')
+
         self.env = env
         self.env.set_start_end(start_node, end_node)  # call set_start_end() in env to set the start and end node
+        self.method = method
+        self.settled = 0
 
 
     def reset(self):
-        self.cost = {node: float('inf') for node in self.env.nodes}  # set to infinity
-        self.predecessor = {node: None for node in self.env.nodes}
-        self.cost[self.env.start_node] = 0  # cost from start node to itself is 0
-        self.priority_queue = [(0, self.env.start_node)]
-
-
-    def calculate_cost(self, current_cost, adj_edge):
-        if self.env.evaluation in ("time"):
-            cost = current_cost + self.env.get_edge_time(adj_edge)
-        else:  # in ("distance")
-            cost = current_cost + self.env.get_edge_distance(adj_edge)
-        return cost
+        self.network = self.env.network
+        self.weights = self.env.get_edge_weights()  # "time" or "distance" of every edge, computed once per env
+        self.start_index = self.network.node_index[self.env.start_node]
+        self.end_index = self.network.node_index[self.env.end_node]
 
 
     # main function in dijkstra
@@ -30,39 +398,28 @@ class Dijkstra:
 
         self.reset()  # the initial state of the algorithm
 
-        while self.priority_queue:
-            current_cost, current_node = heapq.heappop(self.priority_queue) # get the minimum one from the heap
-
-            # If the node is the end node, then stop searching
-            if current_node == self.env.end_node:
-                break
-
-            # Explore the neighbors nodes
-            for adj_edge in self.env.decode_node_to_edges(current_node, direction = 'outgoing'):
-                # Corresponding neighbor node
-                adj_node = self.env.decode_edge_to_node(adj_edge, direction = 'end')
-                # Calculate the cost of the neighbor
-                temp_cost = self.calculate_cost(current_cost, adj_edge)
+        table = travel_table(self.env)
+        if table is not None:  # precomputed, the path is only read back
+            node_path, edge_path = table.path(self.start_index, self.end_index)
+            self.settled = 0
+        elif self.method == "ch":
+            hierarchy, metric = hierarchy_metric(self.env)
+            _, node_path, edge_path, self.settled = hierarchy.query(metric, self.start_index, self.end_index)
+        elif self.method == "bidirectional":
+            _, node_path, edge_path, self.settled = bidirectional_search(self.network, self.weights, self.start_index, self.end_index)
+        else:
+            if self.method == "astar":
+                heuristic = euclidean_heuristic(self.network, self.end_index, self.env.evaluation)
+            elif self.method == "alt":
+                heuristic = alt_landmarks(self.env).heuristic(self.end_index)
+            else:
+                heuristic = None
+            self.cost, self.predecessor_edge, self.settled = shortest_path_tree(self.network, self.weights, self.start_index, self.end_index, heuristic = heuristic)
 
-                # If the tentative distance is less than the current distance of the neighbor
-                if temp_cost < self.cost[adj_node]:
-                    self.cost[adj_node] = temp_cost # update the distance of the neighbor
-                    self.predecessor[adj_node] = current_node # update the predecessor of the neighbor
-                    heapq.heappush(self.priority_queue, (temp_cost, adj_node)) # add the neighbor to the priority queue
-
-        # Construct the path from the start node to the goal node
-        node_path = []
-        edge_path = []
-
-        temp_node = self.env.end_node
-        while temp_node is not None:
-            node_path.append(temp_node)
-            temp_node = self.predecessor[temp_node]
-        node_path.reverse()
-
-        for index in range(len(node_path)-1):
-            intersect_edge = set(self.env.decode_node_to_edges(node_path[index], "outgoing")) & set(self.env.decode_node_to_edges(node_path[index+1], "incoming")) # find the edge between two nodes by knowing their set
-            edge_path.append(next(iter(intersect_edge)))  # temp_edge is a set of elements (only one element here), so use it to get the element rather than the set by change it into iterator and get the next one because of its unordered prop
+            # Construct the path from the start node to the goal node
+            node_path, edge_path = trace_path(self.network, self.predecessor_edge, self.end_index)
+        node_path = [self.env.nodes[node] for node in node_path]
+        edge_path = [self.env.edges[edge] for edge in edge_path]
 
         # time the search process
         end_time = datetime.datetime.now()
@@ -81,3 +438,34 @@ class Dijkstra:
         #     print(f'-- Travelled Distance: {round(self.env.get_edge_distance(edge_path), 2)} m')
 
         return node_path, edge_path
+
+
+class TimeDependentDijkstra:
+    def __init__ (self, env, start_node, end_node, departure = 0):
+        """
+        Fastest route once traffic light waits are counted, see time_dependent_search()
+
+        Args:
+        - env (environment.traffic_env)
+        - start_node (str), end_node (str)
+        - departure (float): time the route starts, in the same clock as the traffic light programs
+        The number of edges settled by the last search() is kept in self.settled
+        """
+        self.env = env
+        self.env.set_start_end(start_node, end_node)
+        self.departure = departure
+        self.settled = 0
+
+
+    def search(self):
+        """
+        Returns:
+        - node_path (list of str), edge_path (list of str)
+        - arrival (float): time end_node is reached, inf if it cannot be
+        """
+        network = self.env.network
+        weights = self.env.get_edge_weights("time")
+        arrival, node_path, edge_path, self.settled = time_dependent_search(
+            self.env, weights, network.node_index[self.env.start_node], network.node_index[self.env.end_node], self.departure)
+
+        return [self.env.nodes[node] for node in node_path], [self.env.edges[edge] for edge in edge_path], arrival
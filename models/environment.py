@@ -1,34 +1,50 @@
 import sys
-import sumolib
-import math
+import numpy as np
 import networkx as nx
 import matplotlib.pyplot as plt
 
+from models import network
+from models import travel_table
+from models import traffic_lights
+from utilities import filecache
+
 class traffic_env:
     def __init__ (self, network_file, tls, congestion = [], evaluation = ""):
         # 1. Define network_file
         self.network_file = network_file  # read the file
 
-        self.net = sumolib.net.readNet(network_file)  # file -> net
-        self.nodes = [node.getID().upper() for node in self.net.getNodes()]  # net -> nodes (ID)
-        self.edges = [edge.getID() for edge in self.net.getEdges()]  # net -> edges (ID)
+        self.network = network.load(network_file)  # file -> compiled network, shared with every other env
+        self.nodes = self.network.nodes  # net -> nodes (ID)
+        self.edges = self.network.edges  # net -> edges (ID)
 
-        self.tls = tls  # [tl_id][link_index]=[90] (dict)
-        self.tls_space = [tl.getID() for tl in self.net.getTrafficLights()]
+        self.tls = tls  # [tl_id][link_index][t] (traffic_lights.TrafficLights)
+        self.tls_space = self.network.tls_ids
         self.tls_meet = []  # to print on map
         self.congestion_meet = []  # to print on map
+        self.link_waits = {}  # (tl_id, link_index) -> seconds to wait at every second of the cycle
+        self.turn_waits = {}  # (edge, next_edge) indices -> (tl_id, wait table of its link), see get_turn_wait()
 
         self.action_space = [0, 1, 2, 3]  # action_space
         self.state_space = self.nodes  # state_space
-        self.edge_label = self.decode_edges_to_label()  # give every edges a label by their direction in the aspect of x-y coordinate
+        self.edge_label = self.network.edge_label_dict  # give every edges a label by their direction in the aspect of x-y coordinate
+
+        # Lookups shared with every env of the network, so that no method scans a list
+        self.node_index = self.network.node_index  # node ID -> index, also the set of valid nodes
+        self.edge_index = self.network.edge_index  # edge ID -> index, also the set of valid edges
+        self.outgoing_edges, self.incoming_edges, self.edge_start, self.edge_end = self.network.lookups()  # node ID -> tuple of edge IDs, edge ID -> node ID
+        self.action_edges, self.action_states = self.network.transition_table(len(self.action_space))  # [node][action] -> edge / node index, -1 if not valid
 
 
         # 2. Define congestions edges with its original pattern
         self.congested_edges = [item[0] for item in congestion]
         self.congestion_duration = [item[1] for item in congestion]  # the duration of so called "traffic jam"
+        self.congested_set = frozenset(self.congested_edges)
+        self.congestion_penalty = {}  # edge ID -> its duration, only the first duplicate counts, like index() did
+        for edge, duration in zip(self.congested_edges, self.congestion_duration):
+            self.congestion_penalty.setdefault(edge, duration)
 
         for edge in self.congested_edges:  # make sure that all congested_edges are in the net
-            if edge not in self.edges:
+            if edge not in self.network.edge_index:
                 sys.exit(f'Error: Invalid congestion_edges {edge}')
         # print(f'Congested Edges: {list(zip(self.congested_edges, self.congestion_duration))}')
         # print(f'Congested/Total: {len(self.congested_edges)}/{len(self.edges)}')
@@ -37,6 +53,18 @@ class traffic_env:
         if evaluation not in ('distance', 'time'):
             sys.exit('Error: Invalid evaluation type, provide only "distance" or "time"')
         self.evaluation = evaluation
+        self.edge_weights = {}  # evaluation -> cost of every edge, see get_edge_weights()
+        self.weight_digests = {}  # evaluation -> content hash of its edge_weights, see get_weights_digest()
+        self.search_data = {}  # (method, evaluation) -> what a search method derives from edge_weights, see dijkstra.hierarchy_metric() and alt_landmarks()
+        self.travel_table = None  # all-pairs table, see use_travel_table()
+
+
+    @property
+    def net(self):
+        """
+        The sumolib net of network_file, only parsed on first use and shared with every other env
+        """
+        return self.network.net
 
 
     # Set starting and ending nodes
@@ -49,9 +77,9 @@ class traffic_env:
         """
 
         # Check if the nodes are valid
-        if start_node not in self.nodes:
+        if start_node not in self.node_index:
             sys.exit('Error: Invalid start node')
-        elif end_node not in self.nodes:
+        elif end_node not in self.node_index:
             sys.exit('Error: Invalid end node')
         else:
             self.start_node = start_node
@@ -78,75 +106,28 @@ class traffic_env:
         if direction not in ('incoming', 'outgoing', None):
             sys.exit(f'Invalid direction: {direction}')
 
-        edges = []
-        net_node = self.net.getNode(node)
-
         # Match node and direction to return edges
         if direction == 'incoming':
-            for edge in net_node.getIncoming():
-                if edge.getToNode().getID() == node:
-                    edges.append(edge.getID())
+            return list(self.incoming_edges[node])
 
         elif direction == 'outgoing':
-            for edge in net_node.getOutgoing():
-                if edge.getFromNode().getID() == node:
-                    edges.append(edge.getID())
+            return list(self.outgoing_edges[node])
 
         else:
-            for edge in net_node.getIncoming() + net_node.getOutgoing():
-                if edge.getToNode().getID() == node or edge.getFromNode().getID() == node:
-                    edges.append(edge.getID())
-
-        return edges
+            return list(self.incoming_edges[node] + self.outgoing_edges[node])
 
 
     # Label edges based of junction from ( 0 Right -> 1 Up -> 2 Left -> 3 Down )
     def decode_edges_to_label(self):
         """
         Iterates through the whole state space and returns a dictionary of each state and the direction it is headed.
+        The labels are computed once per network file, see network.CompiledNetwork.label_edges()
 
         Returns:
         - A dictionary of states (str) matched with its direction.
         """
 
-        edge_labelled = {edge: None for edge in self.edges}
-
-        def get_edge_label(node, outgoing_edges):
-            # get the nodes outgoing
-            start_x, start_y = self.net.getNode(node).getCoord()
-
-            # store edge angle
-            edge_angle = []
-
-            # through each outgoing edge
-            for edge in outgoing_edges:
-                # get the end node of the edge
-                end_node = self.decode_edge_to_node(edge)
-                end_x, end_y = self.net.getNode(end_node).getCoord()
-
-                # get the delta_x and delta_y
-                delta_x = end_x - start_x
-                delta_y = end_y - start_y
-
-                # get the angle by delta_x and delta_y
-                angle = math.degrees(math.atan2(delta_y, delta_x))
-
-                # save the edge and its corresponding angle
-                edge_angle.append((edge, angle))
-
-            # sort from 0 to 180 to -180 to 0 (Right -> Up -> Left -> Down -> Right)
-            edge_angle = sorted(edge_angle, key=lambda x: ((x[1] >= 0) * -180, x[1]))
-
-            # label edges
-            for i in range(len(edge_angle)):
-                edge_labelled[edge_angle[i][0]] = i  # edge_angle[i][0] is the ordered edge, btw [1] is its angle
-
-        for node in self.nodes:
-            outgoing_edges = self.decode_node_to_edges(node, 'outgoing')
-            if outgoing_edges:
-                get_edge_label(node, outgoing_edges)
-
-        return edge_labelled  # note that two edges in opposite directions have different ID (viewed as different edges)
+        return dict(self.network.edge_label_dict)  # note that two edges in opposite directions have different ID (viewed as different edges)
 
 
     # Find the actions from a given edges
@@ -163,18 +144,14 @@ class traffic_env:
 
         # Check if edges is in the edges list
         for edge in edges:
-            if edge not in self.edges:
+            if edge not in self.edge_index:
                 sys.exit(f'Error: Edge {edge} not in Edges Space')
 
         # Get the label of each edge
-        edge_label = self.edge_label
+        labels = {self.edge_label[edge] for edge in edges}
 
         # Returns a list of actions
-        actions_lst = []
-        for action in self.action_space:
-            if action in [edge_label[edge] for edge in edges]:
-                actions_lst.append(action)
-        return actions_lst
+        return [action for action in self.action_space if action in labels]
 
 
     # Find the correspoding edge by given an edge set from a node and action
@@ -192,9 +169,15 @@ class traffic_env:
 
         # Check if edges is in the edges list
         for edge in edges:
-            if edge not in self.edges:
+            if edge not in self.edge_index:
                 sys.exit(f'Error: Edge {edge} not in Edges Space')
 
+        # The edge that action takes from the node the edges start at, if it is one of them
+        if edges and 0 <= action < len(self.action_space):
+            edge = int(self.action_edges[self.network.edge_from[self.edge_index[edges[0]]], action])
+            if edge >= 0 and self.edges[edge] in edges:
+                return self.edges[edge]
+
         # Get the direction of each edge
         edge_label = self.edge_label
 
@@ -220,16 +203,14 @@ class traffic_env:
         """
 
         # Check if edges is in the edges list
-        if search_edge not in self.edges:
+        if search_edge not in self.edge_index:
             sys.exit('Error: Edge not in Edges Space!')
 
-        edge = self.net.getEdge(search_edge)
-
         if direction == 'start':
-            node = edge.getFromNode().getID()
+            node = self.edge_start[search_edge]
 
         elif direction == 'end':
-            node = edge.getToNode().getID()
+            node = self.edge_end[search_edge]
 
         return node
 
@@ -253,12 +234,12 @@ class traffic_env:
 
         for edge in travel_edges:
             # Check if edges are in the edges list
-            if edge not in self.edges:
+            if edge not in self.edge_index:
                 sys.exit(f'Error: Edge {edge} not in Edges Space ...call by get_edge_distance')
             # Sum up the distance of each edges
-            total_distance += self.net.getEdge(edge).getLength()
+            total_distance += self.network.edge_length[self.edge_index[edge]]
 
-        return total_distance
+        return float(total_distance)
 
 
     # Find the total time taken by giving a single edge / an edge_path
@@ -280,17 +261,76 @@ class traffic_env:
         total_time = 0
         for edge in travel_edges:
             # Check if edges are in the edges list
-            if edge not in self.edges:
+            if edge not in self.edge_index:
                 sys.exit(f'Error: Edge {edge} not in Edges Space ...call by get_edge_time')
             # Sum up the distance of each edges
-            total_time += self.net.getEdge(edge).getLength() / self.net.getEdge(edge).getSpeed()
+            total_time += self.network.edge_time[self.edge_index[edge]]
 
         # time punishment for the route
-        for i in range(len(travel_edges)):  # time punishment on a specific edge because of only congested edges
-            if travel_edges[i] in self.congested_edges:
-                total_time += self.congestion_duration[self.congested_edges.index(travel_edges[i])]
+        for edge in travel_edges:  # time punishment on a specific edge because of only congested edges
+            if edge in self.congestion_penalty:
+                total_time += self.congestion_penalty[edge]
+
+        return float(total_time)
+
+
+    # Find the cost of every edge at once
+    def get_edge_weights(self, evaluation = None):
+        """
+        Cost of each single edge, indexed like self.edges and computed once per evaluation
+
+        Args:
+        - evaluation (str): "time" (free-flow time + congestion) or "distance", defaults to self.evaluation
 
-        return total_time
+        Return:
+        - weights (list[E] of float): weights[i] == get_edge_time(edges[i]) or get_edge_distance(edges[i])
+        """
+        evaluation = evaluation or self.evaluation
+
+        if evaluation not in self.edge_weights:
+            if evaluation in ("time"):
+                weights = self.network.edge_time.tolist()
+                for edge, duration in self.congestion_penalty.items():
+                    weights[self.edge_index[edge]] += duration
+            else:
+                weights = self.network.edge_length.tolist()
+            self.edge_weights[evaluation] = weights
+
+        return self.edge_weights[evaluation]
+
+
+    # Hash the cost of every edge once
+    def get_weights_digest(self, evaluation = None):
+        """
+        Content hash of get_edge_weights(evaluation), computed once per evaluation like the weights themselves,
+        to key the caches derived from them without hashing every edge on every query
+
+        Return:
+        - digest (str): filecache.array_digest() of the weights
+        """
+        evaluation = evaluation or self.evaluation
+
+        if evaluation not in self.weight_digests:
+            self.weight_digests[evaluation] = filecache.array_digest(self.get_edge_weights(evaluation))
+
+        return self.weight_digests[evaluation]
+
+
+    # Answer shortest path queries from a precomputed table
+    def use_travel_table(self, build = True, processes = None):
+        """
+        Attach the all-pairs table of this network, congestion and evaluation, so that Dijkstra
+        and the dijkstra.*_to_* functions become lookups. It is memory-mapped from __netcache__ and
+        rebuilt when the network or the weights change; without it queries are searched on the fly.
+
+        Args:
+        - build (bool): build the table if it is missing or stale, otherwise keep searching on the fly
+        - processes (int): worker processes used to build it, defaults to the number of cores
+
+        Return:
+        - void
+        """
+        self.travel_table = travel_table.load(self, build, processes)
 
 
     # Find the time offset caused by the traffic light
@@ -316,49 +356,147 @@ class traffic_env:
         current_time = 0
         for edge in range(len(travel_edges) - 1):
             current_edge = travel_edges[edge]
-            next_edge = travel_edges[edge+1]
 
             # 0. Check if edges are in the edges list
-            if current_edge not in self.edges:
+            if current_edge not in self.network.edge_index:
                 sys.exit(f'Error: Edge {current_edge} not in Edges Space ...call by get_tl_offset')
 
-            if current_edge in self.congested_edges and current_edge not in self.congestion_meet:
+            if current_edge in self.congested_set and current_edge not in self.congestion_meet:
                 self.congestion_meet.append(current_edge)  # to print on map
 
             # 1. Sum up the distance of each edges
-            current_time += self.net.getEdge(current_edge).getLength() / self.net.getEdge(current_edge).getSpeed()
-
-            # 2. Find the end point of the edge
-            tl = self.net.getEdge(current_edge).getToNode().getID()
-            if tl not in self.tls_space:
+            current_index = self.network.edge_index[current_edge]
+            current_time += self.network.edge_time[current_index]
+
+            # 2. Find the traffic light at the end point of the edge, and the wait of the link to next_edge
+            turn = (current_index, self.network.edge_index[travel_edges[edge+1]])
+            if turn not in self.turn_waits:
+                self.turn_waits[turn] = self.get_turn_wait(*turn)
+            tl, wait = self.turn_waits[turn]
+            if tl is None:
                 continue
 
             self.tls_meet.append(tl)  # to print on map
+            if not wait:  # a program of 0 seconds, nothing to wait for
+                continue
 
-            # 3. Find the connection of current_edge and next_edge
-            connections_set = self.net.getTLS(tl).getConnections()
+            # 3. Sum up the idle
+            current_time += wait[int(current_time) % len(wait)]
 
-            for j in range(len(connections_set)):
-                connection = connections_set[j]
-                if connection[0] in self.net.getEdge(current_edge).getLanes() and connection[1] in self.net.getEdge(next_edge).getLanes():
-                    break
+        return float(current_time - self.get_edge_time(travel_edges))
 
-            # 4. Derive that this connection is the nth link of this tl_node
-            tl_phase = self.tls[tl][connection[2]]
 
-            idle_time = 0
-            if tl_phase[int(current_time) % 90] != "r":
-                continue
-            else:
-                for phase_index in range(90):
-                    if tl_phase[(int(current_time) + phase_index) % 90] != "r":
-                        idle_time = phase_index
-                        break
+    def get_turn_wait(self, current_index, next_index):
+        """
+        The traffic light met going from one edge to the next, and its wait table, see traffic_lights.wait_table()
 
-            # 5. Sum up the idle
-            current_time += idle_time
+        Args:
+        - current_index (int), next_index (int): edge indices
 
-        return current_time - self.get_edge_time(travel_edges)
+        Returns:
+        - tl (str), wait (list of int): (None, None) if there is no traffic light at the end point of current_index,
+            wait is empty if the program of tl has no such link (e.g. it has no phases)
+        """
+        tl_index = int(self.network.node_tl[self.network.edge_to[current_index]])
+        if tl_index < 0:
+            return None, None
+
+        # Derive that this connection is the nth link of this tl_node, the last link of it if none matches
+        tl = self.tls_space[tl_index]
+        link_index = self.network.tls_link.get((current_index, next_index, tl_index), int(self.network.tls_last_link[tl_index]))
+
+        if (tl, link_index) not in self.link_waits:
+            link_states = self.tls[tl][link_index] if tl in self.tls and link_index in self.tls[tl] else ''
+            self.link_waits[(tl, link_index)] = traffic_lights.wait_table(link_states)
+        return tl, self.link_waits[(tl, link_index)]
+
+
+    # Encode routes of edge IDs for get_route_costs()
+    def encode_routes(self, routes):
+        """
+        Args:
+        - routes (list of list of str): edge paths
+
+        Returns:
+        - edge_ids (np.ndarray of int): the edge indices of every route, back to back
+        - offsets (np.ndarray[R+1] of int): route r is edge_ids[offsets[r]:offsets[r+1]]
+        """
+        edge_ids, offsets = [], [0]
+        for route in routes:
+            if isinstance(route, str):
+                route = [route]
+            for edge in route:
+                if edge not in self.edge_index:
+                    sys.exit(f'Error: Edge {edge} not in Edges Space ...call by encode_routes')
+                edge_ids.append(self.edge_index[edge])
+            offsets.append(len(edge_ids))
+        return np.array(edge_ids, dtype=np.int64), np.array(offsets, dtype=np.int64)
+
+
+    # Find the time, distance and time offset of the traffic lights of many routes at once
+    def get_route_costs(self, edge_ids, offsets):
+        """
+        get_edge_time(), get_edge_distance() and get_tl_offset() of a whole batch of routes in one call.
+        The sums are numpy gathers and reduceat, only the routes that meet a traffic light are walked
+        one edge at a time, as the wait at each light depends on the time it is reached.
+
+        Args:
+        - edge_ids (np.ndarray of int), offsets (np.ndarray[R+1] of int): the routes, see encode_routes()
+
+        Returns:
+        - time (np.ndarray[R] of float): like get_edge_time()
+        - distance (np.ndarray[R] of float): like get_edge_distance()
+        - tl_offset (np.ndarray[R] of float): like get_tl_offset(), so that time + tl_offset is the time taken with the traffic lights
+        """
+        edge_ids = np.asarray(edge_ids, dtype=np.int64)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if len(offsets) < 1 or offsets[0] != 0 or (np.diff(offsets) < 0).any() or offsets[-1] > len(edge_ids):
+            sys.exit('Error: Invalid route offsets ...call by get_route_costs')
+        edge_ids = edge_ids[:offsets[-1]]
+        if len(edge_ids) and (edge_ids.min() < 0 or edge_ids.max() >= len(self.edges)):
+            sys.exit('Error: Edge not in Edges Space ...call by get_route_costs')
+
+        num_routes = len(offsets) - 1
+        starts = offsets[:-1]
+        routed = np.flatnonzero(np.diff(offsets) > 0)  # reduceat() cannot sum an empty route
+
+        def route_sum(values):
+            total = np.zeros(num_routes)
+            if len(routed):
+                total[routed] = np.add.reduceat(values, starts[routed])
+            return total
+
+        # 1. Time and distance, the congestion added after the free-flow time like get_edge_time()
+        penalty = np.zeros(len(self.edges))
+        for edge, duration in self.congestion_penalty.items():
+            penalty[self.edge_index[edge]] = duration
+        free_flow = self.network.edge_time[edge_ids]
+        time = route_sum(free_flow) + route_sum(penalty[edge_ids])
+        distance = route_sum(self.network.edge_length[edge_ids])
+
+        # 2. Free-flow time of every route, the last edge left out like get_tl_offset()
+        is_last = np.zeros(len(edge_ids), dtype=bool)
+        is_last[offsets[1:][routed] - 1] = True
+        clock = route_sum(np.where(is_last, 0.0, free_flow))
+
+        # 3. Routes that meet a traffic light: the wait at each one depends on the clock, so walk them in order
+        is_tl = ~is_last & (self.network.node_tl[self.network.edge_to[edge_ids]] >= 0)
+        met = np.flatnonzero(route_sum(is_tl.astype(np.float64)) > 0)
+        edge_lst, free_lst, tl_lst = edge_ids.tolist(), free_flow.tolist(), is_tl.tolist()
+        for route_index in met.tolist():
+            current_time = 0
+            for position in range(int(offsets[route_index]), int(offsets[route_index + 1]) - 1):
+                current_time += free_lst[position]
+                if tl_lst[position]:
+                    turn = (edge_lst[position], edge_lst[position + 1])
+                    if turn not in self.turn_waits:
+                        self.turn_waits[turn] = self.get_turn_wait(*turn)
+                    _, wait = self.turn_waits[turn]
+                    if wait:  # a program of 0 seconds, nothing to wait for
+                        current_time += wait[int(current_time) % len(wait)]
+            clock[route_index] = current_time
+
+        return time, distance, clock - time
 
 
     # ------ Graph Visualisation ------
@@ -376,15 +514,12 @@ class traffic_env:
         """
 
         nodes_dict = {}  # a list of x_coord and y_coord of every nodes
-        for node in self.nodes:
-            x_coord, y_coord = self.net.getNode(node).getCoord()
+        for node, (x_coord, y_coord) in zip(self.nodes, self.network.node_xy.tolist()):
             nodes_dict[node] = (x_coord, y_coord)
 
         edges_dict = {}  # a list of from_point and to_point of every edges
-        for edge in self.edges:
-            from_id = self.net.getEdge(edge).getFromNode().getID()
-            to_id = self.net.getEdge(edge).getToNode().getID()
-            edges_dict[edge] = (from_id, to_id)
+        for edge, from_node, to_node in zip(self.edges, self.network.edge_from.tolist(), self.network.edge_to.tolist()):
+            edges_dict[edge] = (self.nodes[from_node], self.nodes[to_node])
 
         # Draw the network layout
         net_G = nx.Graph()
@@ -436,19 +571,28 @@ class traffic_env:
 
         Args:
         - num_episodes (int): number of episodes it took for the model to converge, a trimmed one
-        - logs (dict): the logs of the edges and states it took to converge
+        - logs (dict or EpisodeLog): the logs of the edges and states it took to converge, episodes it did not keep are skipped
 
         Return:
         - Plot of the evaluation (time/distance) at each episode
         """
 
+        episodes = [episode for episode in range(num_episodes) if episode in logs]
+
         plt.title("Performance of Agent")
         plt.xlabel("Episode")
+        # every route in one call, straight from the ids of an EpisodeLog
+        if hasattr(logs, 'edge_paths'):
+            edge_ids, offsets = logs.edge_paths(episodes)
+        else:
+            edge_ids, offsets = self.encode_routes([logs[episode][1] for episode in episodes])
+        time, distance, tl_offset = self.get_route_costs(edge_ids, offsets)
+
         if self.evaluation in ("time"):
             plt.ylabel("Time")
-            evaluation = [(self.get_edge_time(logs[episode][1]) + self.get_tl_offset(logs[episode][1]))/60  for episode in range(num_episodes)]
+            evaluation = (time + tl_offset)/60
         else:
             plt.ylabel("Distance")
-            evaluation = [self.get_edge_distance(logs[episode][1]) for episode in range(num_episodes)]
-        plt.plot(range(num_episodes), evaluation)
+            evaluation = distance
+        plt.plot(episodes, evaluation)
         plt.show()
@@ -1,27 +1,39 @@
 import sys
-import sumolib
 import networkx as nx
 import matplotlib.pyplot as plt
 import random
 import math
+import heapq
+import bisect
+import numpy as np
 
+from models import assignment
 from models import demand
 from models import dijkstra
 from models import environment
+from models import network
+from models import spatial
 from utilities import progressbar
 
 
 class traffic_env:
-    def __init__ (self, network_file, tls, evaluation = "", congestion = [], congestion_level = "", num_vehicle = 20, num_demands = 200):
+    def __init__ (self, network_file, tls, evaluation = "", congestion = [], congestion_level = "", num_vehicle = 20, num_demands = 200, precompute = False, tl_aware = False, candidate_k = None, dispatch_window = 0, demand_source = None):
         # 01 Define network_file
         self.network_file = network_file  # read the file
 
-        self.net = sumolib.net.readNet(network_file)  # file -> net
-        self.nodes = [node.getID().upper() for node in self.net.getNodes()]  # net -> nodes (ID)
-        self.edges = [edge.getID() for edge in self.net.getEdges()]  # net -> edges (ID)
+        self.network = network.load(network_file)  # file -> compiled network, shared with every other env
+        self.nodes = self.network.nodes  # net -> nodes (ID)
+        self.edges = self.network.edges  # net -> edges (ID)
         self.state_space = self.nodes  # state_space
 
         self.tls = tls
+        self.mock_env = environment.traffic_env(network_file = self.network_file, tls = self.tls, evaluation="time")  # to measure commuting time
+        if precompute:
+            self.mock_env.use_travel_table()  # commuting times become table lookups
+        self.tl_aware = tl_aware  # count the traffic lights in commuting times, see add_tl_waits()
+        self.candidate_k = candidate_k  # only time the k idle vehicles closest in straight line, see get_candidate_commutes()
+        self.saved_queries = 0  # idle vehicles the candidate search did not have to time
+        self.dispatch_window = dispatch_window  # seconds the demands are buffered for, see dispatch_batch(), 0 to dispatch them one by one
 
 
         # 02 Define evaluation type
@@ -36,7 +48,7 @@ class traffic_env:
             self.congestion_duration = [item[1] for item in congestion]  # the duration of so called "traffic jam"
 
             for edge in self.congested_edges:  # make sure that all congested_edges are in the net
-                if edge not in self.edges:
+                if edge not in self.network.edge_index:
                     sys.exit(f'Error: Invalid congestion_edges {edge}')
 
         else:  # if congestion is not defined, then set edges and its duration randomly
@@ -54,7 +66,13 @@ class traffic_env:
         # 04 Distribute vehicles in different place and reset their props
         self.num_vehicle = num_vehicle
         self.vehicle_states = []  # list[num_vehicle]
-        self.timeline = []  # list[num_vehicle][current_time]
+        self.intervals = []  # list[num_vehicle] of (start, end, state): 0.5 commuting, 1 working, idle otherwise
+        self.available_time = []  # list[num_vehicle]: end of the last interval of every vehicle
+        self.available_queue = []  # heap of (available_time, vehicle), stale entries are skipped
+        self.idle_queue = []  # heap of the vehicles available by idle_time
+        self.idle_time = 0  # every vehicle is accounted for until then, i.e. the last asking_time
+        self.idle_index = spatial.GridIndex()  # positions of the idle vehicles, kept only with candidate_k
+        self.index_queue = []  # heap of (available_time, vehicle) of the vehicles out of idle_index
         self.asking_time = 0  # record the time demand give to us
         self.waiting_counter = 0  # add busy_time and commute_time, i.e. summing up the time that every passenger is going to wait
         self.reset()  # reset vehicle_states and timeline
@@ -62,9 +80,12 @@ class traffic_env:
         # 05 Define demands
         offset = 0
         self.num_demands = num_demands
-        self.demands = demand.Demand(network_file, tls, offset, num_demands = self.num_demands)
+        if demand_source:  # recorded trips instead of random ones
+            self.demands = demand.TraceDemand(network_file, demand_source, num_demands = self.num_demands)
+        else:
+            self.demands = demand.Demand(network_file, tls, offset, num_demands = self.num_demands, precompute = precompute, tl_aware = tl_aware)
         self.demand_queue = []  # record demands
-        self.demands_counter = 0
+        self.demands_counter = 0  # demands pulled so far, a trace can run out before num_demands
 
 
         # 05 Print props of the network
@@ -76,14 +97,20 @@ class traffic_env:
 
     def reset (self):
         """
-        Initialise vehicle_states randomly and set timeline to 0 (in first column)
+        Initialise vehicle_states randomly and clear the schedule of every vehicle
 
         Args:
         - vehicle_states[num_vehicles]
-        - timeline[num_vehicles][seconds]
+        - intervals[num_vehicles]
         """
         self.vehicle_states = random.choices(self.state_space, k = self.num_vehicle)
-        self.timeline = [[] for _ in range(self.num_vehicle)]
+        self.intervals = [[] for _ in range(self.num_vehicle)]
+        self.available_time = [0] * self.num_vehicle
+        self.available_queue = [(0, vehicle) for vehicle in range(self.num_vehicle)]
+        self.idle_queue = []
+        self.idle_time = 0
+        self.idle_index = spatial.GridIndex()
+        self.index_queue = [(0, vehicle) for vehicle in range(self.num_vehicle)]
         print(f'-- Initial vehicle states: {self.vehicle_states}\n')
 
 
@@ -102,12 +129,12 @@ class traffic_env:
     # ----- Main function (following four functions form a pipeline executing "once" in every demand)
 
     #
-    def update_demand_queue (self):
+    def update_demand_queue (self, demand = None):
         """
         Get the next demand and pop the oldest one to run
 
         Args:
-        - demand(departure_time, start_node, end_node)
+        - demand(departure_time, start_node, end_node): generated beforehand, or None to push a new one
         - demand_queue
         - asking_time
 
@@ -116,7 +143,7 @@ class traffic_env:
         - end_node (str)
         """
         # 01 Pull demand
-        self.demand_queue.append(self.demands.push())
+        self.demand_queue.append(demand if demand is not None else self.demands.push())
         self.demands_counter += 1
 
         self.asking_time = self.demand_queue[-1][0]
@@ -127,8 +154,9 @@ class traffic_env:
         print(f"-- Demand {self.demands_counter}: from '{start_node[0]}' to '{end_node[0]}")
 
 
-        # 02 Pop demand
-        self.demand_queue.pop()
+        # 02 Pop demand, unless it waits in the queue for dispatch_batch()
+        if not self.dispatch_window:
+            self.demand_queue.pop()
 
 
         return start_node[0], end_node[0]
@@ -146,6 +174,10 @@ class traffic_env:
         """
 
         # 01 Define "time_lst" to record the time it spend for the current state to the target point
+        if self.candidate_k:
+            commute_lst = self.get_candidate_commutes(start_node)  # only the closest idle vehicles, traffic lights included if tl_aware
+        else:
+            commute_lst = dijkstra.many_to_one(self.mock_env, self.vehicle_states, start_node)  # one reverse search for the whole fleet
         time_lst = {vehicle: float('inf') for vehicle in range(self.num_vehicle)}  # initialise to [inf, inf, inf, ...]
 
         for vehicle in range(self.num_vehicle):
@@ -153,35 +185,46 @@ class traffic_env:
             finding_bar = progressbar.ProgressBar(vehicle, self.num_vehicle-1, "Finding", "")
             finding_bar.print()
 
-            if self.asking_time < len(self.timeline[vehicle]):
+            if self.is_busy(vehicle, self.asking_time):
                 continue
 
             # Check if the vehicle is idle
-            mock_env = environment.traffic_env(network_file = self.network_file, tls = self.tls, evaluation="time")
-            mock_agent = dijkstra.Dijkstra(mock_env, self.vehicle_states[vehicle], start_node)  # not a agent actually
-            _, edge_path = mock_agent.search()
+            time_lst[vehicle] = commute_lst[vehicle]  # set to [XXX, XXX, inf, ...]. If inf ocuurs, corresponding vehicles are busy or cannot reach start_node
 
-            time_lst[vehicle] = mock_env.get_edge_time(edge_path)  # set to [XXX, XXX, inf, ...]. If inf ocuurs, corresponding vehicles are busy
+        if self.tl_aware and not self.candidate_k:
+            time_lst = self.add_tl_waits(time_lst, start_node)
 
 
         # 02 Use "time_lst" to distinguish which case the env is
-        # Case 1: All the vehicles are busy
+        # Case 1: No idle vehicle can take it, either all the vehicles are busy or the idle ones cannot reach start_node
         if all(math.isinf(value) for value in time_lst.values()):
 
-            # .01 Get which vehicle and when is it going to be available
-            available_time, v_id = min((len(row), index) for index, row in enumerate(self.timeline))
+            # .01 Get which vehicle and when is it going to be available, the first one that can reach start_node
+            available_time, v_id = self.get_next_available()
+            reachable = commute_lst if not self.candidate_k else dijkstra.many_to_one(self.mock_env, self.vehicle_states, start_node)  # a busy vehicle was not timed
+            if math.isinf(reachable[v_id]) and any(not math.isinf(value) for value in reachable):
+                available_time, v_id = min((max(self.available_time[vehicle], self.idle_time), vehicle) for vehicle in range(self.num_vehicle) if not math.isinf(reachable[vehicle]))
 
             # .02 Get the time it spends from idle to the next demand point
-            mock_env = environment.traffic_env(network_file = self.network_file, tls = self.tls, evaluation="time")
-            mock_agent = dijkstra.Dijkstra(mock_env, self.vehicle_states[v_id], start_node)  # not a agent actually
-            _, edge_path = mock_agent.search()
-            commute_time = math.ceil(mock_env.get_edge_time(edge_path))
+            if math.isinf(reachable[v_id]):
+                commute_time = 0  # no vehicle can reach start_node: an empty route, as Dijkstra returns
+            else:
+                if self.candidate_k:
+                    commute_lst[v_id] = self.get_commute(v_id, start_node, max(available_time, self.asking_time))
+                elif self.tl_aware:
+                    commute_lst[v_id] = self.get_tl_commute(v_id, start_node, max(available_time, self.asking_time))
+                commute_time = math.ceil(commute_lst[v_id])
 
             # .03 Set it to the busy time
-            busy_time = available_time - self.asking_time
+            busy_time = max(available_time - self.asking_time, 0)  # 0 if it is idle
             self.waiting_counter += busy_time + commute_time
 
-            print(f'-- All vehicles are busy. After waiting, assigned vehicle id: {v_id}')
+            if math.isinf(reachable[v_id]):
+                print(f'-- No vehicle can reach {start_node}. Assigned vehicle id: {v_id} with an empty route')
+            elif any(not self.is_busy(vehicle, self.asking_time) for vehicle in range(self.num_vehicle)):
+                print(f'-- No idle vehicle can reach {start_node}. After waiting, assigned vehicle id: {v_id}')
+            else:
+                print(f'-- All vehicles are busy. After waiting, assigned vehicle id: {v_id}')
 
         # Case 2: Some vehicles are available
         else:
@@ -190,10 +233,7 @@ class traffic_env:
             v_id = min(time_lst, key=lambda k: time_lst[k])
 
             # .02 Get the time it spends from idle to the next demand point
-            mock_env = environment.traffic_env(network_file = self.network_file, tls = self.tls, evaluation="time")
-            mock_agent = dijkstra.Dijkstra(mock_env, self.vehicle_states[v_id], start_node)  # not a agent actually
-            _, edge_path = mock_agent.search()
-            commute_time = math.ceil(mock_env.get_edge_time(edge_path))
+            commute_time = math.ceil(time_lst[v_id])
 
             # .03 Set it to the busy time
             busy_time = 0
@@ -215,16 +255,163 @@ class traffic_env:
 
 
 
-    def update_idle_timeline (self):
+    def dispatch_batch (self, dispatch_time):
         """
-        Insert 0 to the idle timeline until the asking_time
+        Assign the queued demands asked by dispatch_time all at once, minimising the sum of their waiting times.
+        The commuting times of every vehicle to every demand come from one batched search, and the
+        assignment from assignment.solve(). When there are more demands than vehicles, the oldest ones
+        are assigned and the others are left in the queue for the next dispatch.
 
         Args:
-        - timeline[num_vehicle][seconds]
+        - dispatch_time (int): the end of the window, the demands waited in the queue until then
+        - demand_queue
+
+        Returns:
+        - assignments (list of (position, v_id, commute_time)): position of the demand in demand_queue
+            before the call, in that order
         """
-        for vehicle in range(self.num_vehicle):
-            while len(self.timeline[vehicle]) < self.asking_time:
-                self.timeline[vehicle].append(0)
+        # 01 Take the oldest demands, at most one per vehicle
+        positions = [i for i, (asking_time, _, _) in enumerate(self.demand_queue) if asking_time <= dispatch_time][:self.num_vehicle]
+        if not positions:
+            return []
+
+        self.asking_time = dispatch_time
+        self.update_idle_timeline()
+
+        # 02 Waiting time of every vehicle x demand: until the vehicle is available, then commuting
+        start_nodes = [self.demand_queue[i][1][0] for i in positions]
+        commute_matrix = np.ceil(dijkstra.many_to_many(self.mock_env, self.vehicle_states, start_nodes))  # [num_vehicle, demands]
+        busy_time = np.maximum(np.array(self.available_time) - self.idle_time, 0)
+
+        # a vehicle that cannot reach a demand goes with an empty route, as in get_neerest_vehicle(), which makes it
+        # a last resort: worse than any vehicle that can reach the demand, but better than waiting for one
+        unreachable = np.isinf(commute_matrix)
+        last_resort = np.where(unreachable, 0, commute_matrix).max(axis=0)
+        vehicles, demands = assignment.solve(busy_time[:, None] + np.where(unreachable, last_resort, commute_matrix))
+
+        # 03 Account the waiting of every assigned demand
+        assignments = []
+        for v_id, d in zip(vehicles.tolist(), demands.tolist()):
+            commute_time = commute_matrix[v_id, d]
+            if self.tl_aware and not math.isinf(commute_time):
+                commute_time = math.ceil(self.get_tl_commute(v_id, start_nodes[d], self.idle_time + busy_time[v_id]))
+            commute_time = int(commute_time) if not math.isinf(commute_time) else 0  # unreachable: an empty route, as Dijkstra returns
+
+            self.waiting_counter += (dispatch_time - self.demand_queue[positions[d]][0]) + int(busy_time[v_id]) + commute_time
+            assignments.append((positions[d], v_id, commute_time))
+
+            print(f'-- Demand from {start_nodes[d]} assigned to vehicle id: {v_id} (commuting time: {commute_time})')
+
+        # 04 The others stay in the queue
+        assigned = {position for position, _, _ in assignments}
+        self.demand_queue = [demand for i, demand in enumerate(self.demand_queue) if i not in assigned]
+
+        print(f'-- Dispatched {len(assignments)} demands at {dispatch_time}, {len(self.demand_queue)} left in the queue\n')
+
+        return sorted(assignments)
+
+
+
+    def add_tl_waits (self, time_lst, start_node):
+        """
+        Count the traffic lights in the commuting times of the idle vehicles, departing at asking_time.
+        The time without them is a lower bound, so the vehicles are tried from the closest one and
+        the search stops once the next lower bound cannot beat the best time found.
+
+        Args:
+        - time_lst (dict): vehicle -> commuting time without traffic lights, inf if busy or unreachable
+        - start_node (str)
+
+        Returns:
+        - tl_time_lst (dict): vehicle -> commuting time with traffic lights, inf if busy, unreachable or skipped
+        """
+        tl_time_lst = {vehicle: float('inf') for vehicle in time_lst}
+        best_time = float('inf')
+
+        for vehicle in sorted((v for v in time_lst if not math.isinf(time_lst[v])), key=lambda v: time_lst[v]):
+            if time_lst[vehicle] >= best_time:
+                break
+            tl_time_lst[vehicle] = self.get_tl_commute(vehicle, start_node, self.asking_time)
+            best_time = min(best_time, tl_time_lst[vehicle])
+
+        return tl_time_lst
+
+
+
+    def get_candidate_commutes (self, start_node):
+        """
+        Time the idle vehicles from the closest one to start_node in straight line, at most candidate_k of them.
+        A vehicle whose landmark lower bound (see landmarks.py) is already above the best time found cannot
+        be the fastest one, so it is skipped without being timed and does not count in the k.
+        A vehicle beyond the k closest ones timed is never timed, even if the roads make it the fastest one.
+
+        Args:
+        - start_node (str)
+
+        Returns:
+        - commute_lst (list[num_vehicle] of float): commuting time of the timed vehicles, inf for the others
+        """
+        self.update_idle_index()
+
+        commute_lst = [float('inf')] * self.num_vehicle
+        best_time = float('inf')
+        timed = 0
+        start_index = self.network.node_index[start_node]
+        x, y = self.network.node_xy[start_index].tolist()
+        bound = dijkstra.alt_landmarks(self.mock_env).heuristic(start_index)  # node -> lower bound of its time to start_node, traffic lights left out
+
+        for _, vehicle in self.idle_index.nearest(x, y):
+            if timed == self.candidate_k:
+                break
+            if bound[self.network.node_index[self.vehicle_states[vehicle]]] > best_time:
+                continue
+            commute_lst[vehicle] = self.get_commute(vehicle, start_node, self.asking_time)
+            best_time = min(best_time, commute_lst[vehicle])
+            timed += 1
+
+        self.saved_queries += len(self.idle_index) - timed
+        return commute_lst
+
+
+
+    def update_idle_index (self):
+        """
+        Put the vehicles that are available by asking_time back in idle_index, at the node they stopped at
+        """
+        while self.index_queue and self.index_queue[0][0] <= self.asking_time:
+            available_time, vehicle = heapq.heappop(self.index_queue)
+            if available_time == self.available_time[vehicle]:  # not scheduled again since
+                x, y = self.network.node_xy[self.network.node_index[self.vehicle_states[vehicle]]].tolist()
+                self.idle_index.insert(vehicle, x, y)
+
+
+
+    def get_commute (self, v_id, start_node, departure):
+        """
+        Returns:
+        - commute_time (float): time v_id takes to go to start_node, with the traffic lights if tl_aware, inf if unreachable
+        """
+        if self.tl_aware:
+            return self.get_tl_commute(v_id, start_node, departure)
+        return dijkstra.one_to_one(self.mock_env, self.vehicle_states[v_id], start_node)
+
+
+
+    def get_tl_commute (self, v_id, start_node, departure):
+        """
+        Returns:
+        - commute_time (float): time v_id takes to go to start_node leaving at departure, traffic lights included
+        """
+        _, _, arrival = dijkstra.TimeDependentDijkstra(self.mock_env, self.vehicle_states[v_id], start_node, departure).search()
+        return arrival - departure
+
+
+
+    def update_idle_timeline (self):
+        """
+        Account every vehicle as idle until the asking_time, i.e. nothing can be scheduled before it anymore
+        """
+        self.idle_time = max(self.idle_time, self.asking_time)
 
 
 
@@ -232,21 +419,104 @@ class traffic_env:
     #
     def set_vehicle_working (self, v_id, commute_time, working_time, end_node):
         """
-        Insert 0.5 to the timeline for commute_time and 1 for working_time
+        Schedule commute_time (0.5) then working_time (1) from when v_id is available
 
         Args:
-        - timeline[num_vehicle][seconds]
+        - intervals[num_vehicle]
         """
-        for _ in range(commute_time):
-            self.timeline[v_id].append(0.5)
-
-        for _ in range(working_time):
-            self.timeline[v_id].append(1)
+        start = max(self.available_time[v_id], self.idle_time)
+        if commute_time:
+            self.intervals[v_id].append((start, start + commute_time, 0.5))
+        if working_time:
+            self.intervals[v_id].append((start + commute_time, start + commute_time + working_time, 1))
+
+        self.available_time[v_id] = start + commute_time + working_time
+        heapq.heappush(self.available_queue, (self.available_time[v_id], v_id))
+        if self.candidate_k:
+            self.idle_index.remove(v_id)  # back in by update_idle_index() once available
+            heapq.heappush(self.index_queue, (self.available_time[v_id], v_id))
 
         self.vehicle_states[v_id] = end_node
 
 
 
+    # ----- Schedule queries
+
+    def is_busy (self, v_id, time):
+        """
+        Whether v_id is committed at time, to a job it is doing or one it is going to do
+
+        Returns:
+        - bool, in O(1)
+        """
+        return time < max(self.available_time[v_id], self.idle_time)
+
+
+
+    def get_state (self, v_id, time):
+        """
+        Returns:
+        - state (float): what v_id does at second time, 0 idle, 0.5 commuting or 1 working, in O(log intervals)
+        """
+        intervals = self.intervals[v_id]
+        i = bisect.bisect_right(intervals, (time, float('inf'), float('inf'))) - 1
+        if i >= 0 and intervals[i][0] <= time < intervals[i][1]:
+            return intervals[i][2]
+        return 0
+
+
+
+    def get_next_available (self):
+        """
+        The vehicle available first, the lowest id among the ones that are available by idle_time
+
+        Returns:
+        - available_time (int), v_id (int), in O(log num_vehicle) amortised
+        """
+        # move the vehicles available by idle_time to the queue ordered by id
+        while self.available_queue and self.available_queue[0][0] <= self.idle_time:
+            available_time, vehicle = heapq.heappop(self.available_queue)
+            if available_time == self.available_time[vehicle]:
+                heapq.heappush(self.idle_queue, vehicle)
+
+        while self.idle_queue and self.available_time[self.idle_queue[0]] > self.idle_time:  # scheduled again since
+            heapq.heappop(self.idle_queue)
+        if self.idle_queue:
+            return self.idle_time, self.idle_queue[0]
+
+        while self.available_queue[0][0] != self.available_time[self.available_queue[0][1]]:  # stale entry
+            heapq.heappop(self.available_queue)
+        return self.available_queue[0]
+
+
+
+    def get_end_time (self):
+        """
+        Returns:
+        - end_time (int): when every vehicle is done, the length of the timeline
+        """
+        return max(self.available_time + [self.idle_time])
+
+
+
+    @property
+    def timeline (self):
+        """
+        The schedule as one state per second of every vehicle (0 idle, 0.5 commuting, 1 working),
+        derived from the intervals on demand
+
+        Returns:
+        - timeline[num_vehicle][seconds]: ragged, every row ends when its vehicle is available
+        """
+        timeline = []
+        for vehicle in range(self.num_vehicle):
+            row = [0] * max(self.available_time[vehicle], self.idle_time)
+            for start, end, state in self.intervals[vehicle]:
+                row[start:end] = [state] * (end - start)
+            timeline.append(row)
+        return timeline
+
+
 
 
     # ----- print result
@@ -257,11 +527,11 @@ class traffic_env:
         """
         Fill the timeline with 0 to make it a rectangle
 
-        Args:
+        Returns:
         - timeline[num_vehicle][seconds]
         """
-        max_length = max(len(row) for row in self.timeline)
-        self.timeline = [row + [0] * (max_length - len(row)) for row in self.timeline]
+        max_length = self.get_end_time()
+        return [row + [0] * (max_length - len(row)) for row in self.timeline]
 
 
 
@@ -270,10 +540,12 @@ class traffic_env:
         """
         Print the result of the simulation
         """
-        max_length = max(len(row) for row in self.timeline)
+        max_length = self.get_end_time()
 
         print(f'-- Total Time: {round(max_length/60, 2)} min')
-        print(f'-- Average Waiting Time: {round(self.waiting_counter/self.num_demands/60, 2)} min')
+        print(f'-- Average Waiting Time: {round(self.waiting_counter/max(self.demands_counter, 1)/60, 2)} min')
+        if self.candidate_k:
+            print(f'-- Commuting Times Saved by the Candidate Search: {self.saved_queries}')
 
 
     #
@@ -281,8 +553,13 @@ class traffic_env:
         """
         Plot the gantt chart of the simulation
         """
-        self.fill_timeline()
-        plt.imshow(self.timeline, cmap='Greys', aspect='auto', interpolation='nearest')
+        _, ax = plt.subplots()
+        for vehicle in range(self.num_vehicle):
+            for state, color in ((0.5, 'Grey'), (1, 'Black')):
+                bars = [(start, end - start) for start, end, s in self.intervals[vehicle] if s == state]
+                ax.broken_barh(bars, (vehicle - 0.5, 1), facecolors=color)
+        ax.set_xlim(0, max(self.get_end_time(), 1))
+        ax.set_ylim(self.num_vehicle - 0.5, -0.5)  # vehicle 0 on the top
         plt.xlabel('Time')
         plt.ylabel('Vehicle')
         plt.yticks(range(self.num_vehicle))
@@ -296,15 +573,12 @@ class traffic_env:
         """
 
         nodes_dict = {}  # a list of x_coord and y_coord of every nodes
-        for node in self.nodes:
-            x_coord, y_coord = self.net.getNode(node).getCoord()
+        for node, (x_coord, y_coord) in zip(self.nodes, self.network.node_xy.tolist()):
             nodes_dict[node] = (x_coord, y_coord)
 
         edges_dict = {}  # a list of from_point and to_point of every edges
-        for edge in self.edges:
-            from_id = self.net.getEdge(edge).getFromNode().getID()
-            to_id = self.net.getEdge(edge).getToNode().getID()
-            edges_dict[edge] = (from_id, to_id)
+        for edge, from_node, to_node in zip(self.edges, self.network.edge_from.tolist(), self.network.edge_to.tolist()):
+            edges_dict[edge] = (self.nodes[from_node], self.nodes[to_node])
 
         # Draw the network layout
         net_G = nx.Graph()
@@ -0,0 +1,99 @@
+import numpy as np
+
+from models import dijkstra
+from utilities import filecache
+
+
+_landmarks = {}  # (network_file, evaluation, digest of the weights) -> Landmarks
+
+
+def load(network, weights, evaluation, num_landmarks = 8, digest = None):
+    """
+    Return the landmark tables of a network and edge weights, computed once and cached on disk
+
+    Args:
+    - network (CompiledNetwork)
+    - weights (list[E] of float): cost of each edge
+    - evaluation (str): "time" or "distance", only used to keep one cache per evaluation
+    - num_landmarks (int)
+    - digest (str): filecache.array_digest(weights) if the caller already knows it
+
+    Returns:
+    - landmarks (Landmarks)
+    """
+    key = (network.network_file, evaluation, digest or filecache.array_digest(weights))
+    if key not in _landmarks:
+        tag = f'alt.{evaluation}'
+        arrays = filecache.load(network.network_file, tag, key[2])
+        if arrays is None or len(arrays['landmarks']) != num_landmarks:
+            arrays = select_landmarks(network, weights, num_landmarks)
+            filecache.save(network.network_file, tag, arrays, key[2])
+        _landmarks[key] = Landmarks(arrays)
+    return _landmarks[key]
+
+
+def select_landmarks(network, weights, num_landmarks):
+    """
+    Farthest landmark selection: every new landmark is the node farthest from the ones chosen so far
+
+    Returns:
+    - arrays (dict):
+        landmarks[L]: node indices
+        cost_from[L, N]: cost from each landmark to every node
+        cost_to[L, N]: cost from every node to each landmark
+    """
+    num_nodes = len(network.nodes)
+    num_landmarks = min(num_landmarks, num_nodes)
+    landmarks = []
+    cost_from = np.empty((num_landmarks, num_nodes), dtype=np.float64)
+    cost_to = np.empty((num_landmarks, num_nodes), dtype=np.float64)
+    nearest = np.full(num_nodes, np.inf)  # cost between each node and its closest landmark
+    candidate = 0
+
+    for i in range(num_landmarks):
+        landmarks.append(candidate)
+        cost_from[i] = dijkstra.shortest_path_tree(network, weights, candidate)[0]
+        cost_to[i] = dijkstra.shortest_path_tree(network, weights, candidate, reverse = True)[0]
+
+        both = np.minimum(cost_from[i], cost_to[i])
+        nearest = np.minimum(nearest, both)
+        reachable = np.where(np.isfinite(nearest), nearest, -1)  # unreachable nodes make poor landmarks
+        reachable[landmarks] = -1
+        candidate = int(np.argmax(reachable))
+
+    return {
+        'landmarks': np.array(landmarks, dtype=np.int32),
+        'cost_from': cost_from,
+        'cost_to': cost_to,
+    }
+
+
+class Landmarks:
+    def __init__ (self, arrays):
+        """
+        ALT tables, see select_landmarks()
+        """
+        self.landmarks = arrays['landmarks']
+        self.cost_from = arrays['cost_from']
+        self.cost_to = arrays['cost_to']
+
+
+    def heuristic(self, target, reverse = False):
+        """
+        Lower bound of the cost from every node to target by the triangle inequality,
+        max over the landmarks L of d(L, t) - d(L, v) and d(v, L) - d(t, L)
+
+        Args:
+        - target (int): node index
+        - reverse (bool): lower bounds of the cost from target to every node instead
+
+        Returns:
+        - bound (list[N] of float): inf where target is provably unreachable
+        """
+        with np.errstate(invalid='ignore'):  # inf - inf, both sides unreachable from a landmark, says nothing
+            if reverse:
+                terms = (self.cost_from - self.cost_from[:, [target]], self.cost_to[:, [target]] - self.cost_to)
+            else:
+                terms = (self.cost_from[:, [target]] - self.cost_from, self.cost_to - self.cost_to[:, [target]])
+            bound = np.nan_to_num(np.maximum(*terms), nan=0.0, posinf=np.inf, neginf=0.0).max(axis=0)
+        return np.maximum(bound, 0.0).tolist()
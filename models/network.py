@@ -0,0 +1,311 @@
+import os
+import math
+import numpy as np
+import sumolib
+
+from models import spatial
+from utilities import filecache
+
+
+_networks = {}  # abspath(network_file) -> CompiledNetwork, shared by every env in the process
+
+
+def load(network_file):
+    """
+    Return the compiled network of network_file, parsing it only the first time it is asked for.
+    The arrays are also cached on disk (keyed by the content hash of the file),
+    so later runs skip sumolib altogether until the file changes.
+
+    Args:
+    - network_file (str): path to the .net.xml(.gz) file
+
+    Returns:
+    - network (CompiledNetwork)
+    """
+    key = os.path.abspath(network_file)
+    if key not in _networks:
+        arrays = filecache.load(network_file, 'net')
+        if arrays is None:
+            arrays = compile_network(network_file)
+            filecache.save(network_file, 'net', arrays)
+        _networks[key] = CompiledNetwork(network_file, arrays)
+    return _networks[key]
+
+
+def compile_network(network_file):
+    """
+    Parse network_file with sumolib and flatten it into plain arrays
+
+    Args:
+    - network_file (str): path to the .net.xml(.gz) file
+
+    Returns:
+    - arrays (dict): name -> np.ndarray, see CompiledNetwork for the meaning of each entry
+    """
+    net = sumolib.net.readNet(network_file)  # file -> net
+
+    # 01 Nodes, keep the sumolib order since it is the state space order
+    net_nodes = net.getNodes()
+    node_ids = [node.getID().upper() for node in net_nodes]
+    node_index = {node: i for i, node in enumerate(node_ids)}
+    node_xy = np.array([node.getCoord()[:2] for node in net_nodes], dtype=np.float64).reshape(-1, 2)
+
+    # 02 Edges
+    net_edges = net.getEdges()
+    edge_ids = [edge.getID() for edge in net_edges]
+    edge_index = {edge: i for i, edge in enumerate(edge_ids)}
+    edge_from = np.array([node_index[edge.getFromNode().getID().upper()] for edge in net_edges], dtype=np.int32)
+    edge_to = np.array([node_index[edge.getToNode().getID().upper()] for edge in net_edges], dtype=np.int32)
+    edge_length = np.array([edge.getLength() for edge in net_edges], dtype=np.float64)
+    edge_speed = np.array([edge.getSpeed() for edge in net_edges], dtype=np.float64)
+    shape_ptr, shape_xy = [0], []  # the shape of edge e is shape_xy[shape_ptr[e]:shape_ptr[e+1]], at least its two ends
+    for edge in net_edges:
+        shape = edge.getShape() or [edge.getFromNode().getCoord(), edge.getToNode().getCoord()]
+        shape_xy += [point[:2] for point in (shape if len(shape) > 1 else shape * 2)]
+        shape_ptr.append(len(shape_xy))
+
+    # 03 CSR adjacency, following the order sumolib keeps in getOutgoing() / getIncoming()
+    out_ptr, out_edges = [0], []
+    in_ptr, in_edges = [0], []
+    for node in net_nodes:
+        out_edges += [edge_index[edge.getID()] for edge in node.getOutgoing()]
+        in_edges += [edge_index[edge.getID()] for edge in node.getIncoming()]
+        out_ptr.append(len(out_edges))
+        in_ptr.append(len(in_edges))
+
+    # 04 Traffic lights: (from_edge, to_edge) -> (tl, link_index) for every controlled connection
+    net_tls = net.getTrafficLights()
+    tls_ids = [tl.getID() for tl in net_tls]
+    link_seen = set()
+    link_from, link_to, link_tl, link_index = [], [], [], []
+    tls_last_link = []  # the link get_tl_offset() falls back on when no connection matches
+    for tl_index, tl in enumerate(net_tls):
+        connections = tl.getConnections()
+        tls_last_link.append(connections[-1][2] if connections else -1)
+        for in_lane, out_lane, link in connections:
+            pair = (edge_index[in_lane.getEdge().getID()], edge_index[out_lane.getEdge().getID()], tl_index)
+            if pair in link_seen:  # keep the first matching connection, as the linear scan did
+                continue
+            link_seen.add(pair)
+            link_from.append(pair[0])
+            link_to.append(pair[1])
+            link_tl.append(tl_index)
+            link_index.append(link)
+
+    return {
+        'node_ids': np.array(node_ids, dtype=str),
+        'node_xy': node_xy,
+        'edge_ids': np.array(edge_ids, dtype=str),
+        'edge_from': edge_from,
+        'edge_to': edge_to,
+        'edge_length': edge_length,
+        'edge_speed': edge_speed,
+        'shape_ptr': np.array(shape_ptr, dtype=np.int64),
+        'shape_xy': np.array(shape_xy, dtype=np.float64).reshape(-1, 2),
+        'net_offset': np.array(net.getLocationOffset() if 'netOffset' in net._location else [0, 0], dtype=np.float64),
+        'proj_parameter': np.array(net._location.get('projParameter', '!'), dtype=str),
+        'out_ptr': np.array(out_ptr, dtype=np.int32),
+        'out_edges': np.array(out_edges, dtype=np.int32),
+        'in_ptr': np.array(in_ptr, dtype=np.int32),
+        'in_edges': np.array(in_edges, dtype=np.int32),
+        'tls_ids': np.array(tls_ids, dtype=str),
+        'tls_last_link': np.array(tls_last_link, dtype=np.int32),
+        'link_from': np.array(link_from, dtype=np.int32),
+        'link_to': np.array(link_to, dtype=np.int32),
+        'link_tl': np.array(link_tl, dtype=np.int32),
+        'link_index': np.array(link_index, dtype=np.int32),
+    }
+
+
+class CompiledNetwork:
+    def __init__ (self, network_file, arrays):
+        """
+        Read-only, integer indexed view of a SUMO network
+
+        Args:
+        - network_file (str): the file it was compiled from
+        - arrays (dict): output of compile_network()
+            node_ids[N], node_xy[N, 2]
+            edge_ids[E], edge_from[E], edge_to[E], edge_length[E], edge_speed[E]
+            shape_ptr[E+1], shape_xy[S, 2]: the shape of edge e is shape_xy[shape_ptr[e]:shape_ptr[e+1]]
+            net_offset[2], proj_parameter: how lon/lat map to x-y, see spatial.NetworkLocator.lonlat_to_xy()
+            out_ptr[N+1], out_edges[E]: outgoing edges of node n are out_edges[out_ptr[n]:out_ptr[n+1]]
+            in_ptr[N+1], in_edges[E]: same for incoming edges
+            tls_ids[T], tls_last_link[T]
+            link_from[L], link_to[L], link_tl[L], link_index[L]: controlled connections
+        """
+        self.network_file = network_file
+        self._net = None  # sumolib net, only parsed if someone really asks for it
+        self._adjacency = {}  # reverse -> adjacency as python lists, see adjacency_lists()
+        self._locator = None  # spatial.NetworkLocator, only built if someone asks for it
+        self._transitions = {}  # num_actions -> transition_table()
+        self._lookups = None  # see lookups()
+
+        # 01 Nodes
+        self.nodes = arrays['node_ids'].tolist()
+        self.node_index = {node: i for i, node in enumerate(self.nodes)}
+        self.node_xy = arrays['node_xy']
+
+        # 02 Edges
+        self.edges = arrays['edge_ids'].tolist()
+        self.edge_index = {edge: i for i, edge in enumerate(self.edges)}
+        self.edge_from = arrays['edge_from']
+        self.edge_to = arrays['edge_to']
+        self.edge_length = arrays['edge_length']
+        self.edge_speed = arrays['edge_speed']
+        self.edge_time = self.edge_length / self.edge_speed  # free-flow time
+        self.shape_ptr = arrays['shape_ptr']
+        self.shape_xy = arrays['shape_xy']
+        self.net_offset = arrays['net_offset']
+        self.proj_parameter = str(arrays['proj_parameter'])
+        self.max_speed = float(self.edge_speed.max()) if len(self.edges) else 1.0
+
+        # lengths are measured along the lanes, which can be shorter than the straight line between the junction
+        # centres, so straight lines are scaled by this factor to stay a lower bound of any path length
+        straight = np.hypot(*(self.node_xy[self.edge_to] - self.node_xy[self.edge_from]).T)
+        ratio = self.edge_length[straight > 0] / straight[straight > 0]
+        self.euclidean_factor = float(min(1.0, ratio.min())) if len(ratio) else 1.0
+
+        # 03 Adjacency
+        self.out_ptr = arrays['out_ptr']
+        self.out_edges = arrays['out_edges']
+        self.in_ptr = arrays['in_ptr']
+        self.in_edges = arrays['in_edges']
+
+        # 04 Traffic lights
+        self.tls_ids = arrays['tls_ids'].tolist()
+        self.tls_last_link = arrays['tls_last_link']
+        self.node_tl = np.full(len(self.nodes), -1, dtype=np.int32)  # node -> tl controlling it (same ID), -1 if none
+        for tl_index, tl in enumerate(self.tls_ids):
+            if tl.upper() in self.node_index:
+                self.node_tl[self.node_index[tl.upper()]] = tl_index
+        self.tls_link = {
+            (from_edge, to_edge, tl): link
+            for from_edge, to_edge, tl, link in zip(
+                arrays['link_from'].tolist(), arrays['link_to'].tolist(),
+                arrays['link_tl'].tolist(), arrays['link_index'].tolist())
+        }
+
+        # 05 Labels of edges ( 0 Right -> 1 Up -> 2 Left -> 3 Down )
+        self.edge_label = self.label_edges()
+        self.edge_label_dict = dict(zip(self.edges, self.edge_label.tolist()))  # the form traffic_env exposes
+
+
+    def outgoing(self, node):
+        """
+        Returns:
+        - np.ndarray of the outgoing edge indices of node (int)
+        """
+        return self.out_edges[self.out_ptr[node]:self.out_ptr[node+1]]
+
+
+    def incoming(self, node):
+        """
+        Returns:
+        - np.ndarray of the incoming edge indices of node (int)
+        """
+        return self.in_edges[self.in_ptr[node]:self.in_ptr[node+1]]
+
+
+    def adjacency_lists(self, reverse = False):
+        """
+        CSR adjacency as plain python lists, which is what the pure python searches index fastest
+
+        Args:
+        - reverse (bool): walk the transposed graph, i.e. incoming edges and their start node
+
+        Returns:
+        - ptr (list[N+1]), edges (list[E]), head (list[E]):
+            the edges leaving node n are edges[ptr[n]:ptr[n+1]] and edge e leads to head[e]
+        """
+        if reverse not in self._adjacency:
+            if reverse:
+                self._adjacency[reverse] = (self.in_ptr.tolist(), self.in_edges.tolist(), self.edge_from.tolist())
+            else:
+                self._adjacency[reverse] = (self.out_ptr.tolist(), self.out_edges.tolist(), self.edge_to.tolist())
+        return self._adjacency[reverse]
+
+
+    def transition_table(self, num_actions):
+        """
+        Where every action leads to, following the edge labels
+
+        Args:
+        - num_actions (int): size of the action space, labels beyond it cannot be chosen
+
+        Returns (computed once per num_actions, read-only):
+        - next_edge (np.ndarray[N, num_actions]): edge taken by action a at node n, -1 if a is not valid there
+        - next_state (np.ndarray[N, num_actions]): the node that edge leads to, -1 if a is not valid there
+        """
+        if num_actions not in self._transitions:
+            next_edge = np.full((len(self.nodes), num_actions), -1, dtype=np.int32)
+            valid = self.edge_label < num_actions  # labels are unique among the outgoing edges of a node
+            next_edge[self.edge_from[valid], self.edge_label[valid]] = np.flatnonzero(valid)
+            next_state = np.where(next_edge >= 0, self.edge_to[next_edge], -1).astype(np.int32)
+            next_edge.setflags(write=False)
+            next_state.setflags(write=False)
+            self._transitions[num_actions] = (next_edge, next_state)
+        return self._transitions[num_actions]
+
+
+    def lookups(self):
+        """
+        The adjacency keyed by IDs, for the code that works with IDs, built once and shared by every env
+
+        Returns:
+        - outgoing (dict): node ID -> tuple of the IDs of its outgoing edges, in the order of outgoing()
+        - incoming (dict): node ID -> tuple of the IDs of its incoming edges, in the order of incoming()
+        - edge_start (dict), edge_end (dict): edge ID -> node ID
+        """
+        if self._lookups is None:
+            out_ptr, out_edges, in_ptr, in_edges = self.out_ptr.tolist(), self.out_edges.tolist(), self.in_ptr.tolist(), self.in_edges.tolist()
+            outgoing = {node: tuple(self.edges[edge] for edge in out_edges[out_ptr[i]:out_ptr[i+1]]) for i, node in enumerate(self.nodes)}
+            incoming = {node: tuple(self.edges[edge] for edge in in_edges[in_ptr[i]:in_ptr[i+1]]) for i, node in enumerate(self.nodes)}
+            edge_start = {edge: self.nodes[node] for edge, node in zip(self.edges, self.edge_from.tolist())}
+            edge_end = {edge: self.nodes[node] for edge, node in zip(self.edges, self.edge_to.tolist())}
+            self._lookups = (outgoing, incoming, edge_start, edge_end)
+        return self._lookups
+
+
+    def label_edges(self):
+        """
+        Give every outgoing edge of a node a label by its direction in the aspect of x-y coordinate,
+        sorted from 0 to 180 to -180 to 0 (Right -> Up -> Left -> Down -> Right)
+
+        Returns:
+        - edge_label (np.ndarray[E] of int)
+        """
+        edge_label = np.zeros(len(self.edges), dtype=np.int32)
+        node_xy = self.node_xy.tolist()
+        angles = [
+            math.degrees(math.atan2(node_xy[end][1] - node_xy[start][1], node_xy[end][0] - node_xy[start][0]))
+            for start, end in zip(self.edge_from.tolist(), self.edge_to.tolist())
+        ]
+
+        for node in range(len(self.nodes)):
+            edge_angle = [(edge, angles[edge]) for edge in self.outgoing(node).tolist()]
+            edge_angle = sorted(edge_angle, key=lambda x: ((x[1] >= 0) * -180, x[1]))
+            for i in range(len(edge_angle)):
+                edge_label[edge_angle[i][0]] = i
+
+        return edge_label
+
+
+    @property
+    def locator(self):
+        """
+        Nearest node and edge of arbitrary coordinates, built on first use
+        """
+        if self._locator is None:
+            self._locator = spatial.NetworkLocator(self)
+        return self._locator
+
+
+    @property
+    def net(self):
+        """
+        The sumolib net, parsed lazily for code that still needs the full object model
+        """
+        if self._net is None:
+            self._net = sumolib.net.readNet(self.network_file)
+        return self._net
@@ -0,0 +1,115 @@
+import os
+import math
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from models import agent
+from models import environment
+from models import network
+from utilities import progressbar
+
+
+def solve_routes(network_file, tls, congestion, evaluation, od_pairs, num_episodes, threshold, processes = None, warm_start = False, goal_conditioned = False, warm_radius = 0):
+    """
+    Train a Q_Learning agent for every OD pair, spread over a process pool. The pairs do not depend
+    on each other, so they can be solved before the dispatch, which is then replayed in demand order.
+
+    Args:
+    - network_file (str), tls (dict), congestion (list), evaluation (str): the env every agent trains in
+    - od_pairs (list of (str, str)): (start_node, end_node) of every demand
+    - num_episodes (int), threshold (int): see rl_agent.train()
+    - processes (int): worker processes, defaults to the number of cores, 1 to train in this process
+    - warm_start (bool): start every Q-table from the shortest path potentials, and pairs going to the same
+        end node from the table learned by the previous one, see rl_agent.set_warm_start()
+    - warm_radius (float): with warm_start, pairs going to an end node within warm_radius (m) of one trained
+        before also start from its table. The end nodes are grouped by grid cells of that size, so only
+        the ones sharing a cell are seen as nearby. 0 to only reuse the table of the same end node
+    - goal_conditioned (bool): keep one Q-table per end node, see agent.Goal_Q_Learning, so that pairs going to
+        an end node seen before are mostly greedy rollouts
+
+    Returns:
+    - routes (list of (node_path, edge_path, episode)): in the order of od_pairs
+    """
+    processes = processes or os.cpu_count() or 1
+    routes = [None] * len(od_pairs)
+
+    # Pairs sharing an end node are trained by the same task in demand order, so the result does not depend on the pool
+    # With warm_radius, the pairs whose end nodes share a grid cell are grouped instead, so that they can share tables
+    net = network.load(network_file)
+    groups = {}
+    for i, (_, end_node) in enumerate(od_pairs):
+        if warm_start and warm_radius > 0 and not goal_conditioned:
+            x, y = net.node_xy[net.node_index[end_node]].tolist()
+            key = (math.floor(x / warm_radius), math.floor(y / warm_radius))
+        else:
+            key = end_node if warm_start or goal_conditioned else i
+        groups.setdefault(key, []).append(i)
+    groups = list(groups.values())
+
+    if processes == 1:
+        init_worker(network_file, tls, congestion, evaluation, silent = False)
+        for group in groups:
+            for i, route in zip(group, solve_group([od_pairs[i] for i in group], num_episodes, threshold, warm_start, goal_conditioned, warm_radius)):
+                routes[i] = route
+        return routes
+
+    # fork lets the workers inherit the compiled network instead of parsing the file again
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=init_worker, initargs=(network_file, tls, congestion, evaluation)) as executor:
+        futures = [executor.submit(solve_group, [od_pairs[i] for i in group], num_episodes, threshold, warm_start, goal_conditioned, warm_radius) for group in groups]
+        for group, future in zip(groups, futures):
+            for i, route in zip(group, future.result()):  # a pair that cannot converge exits here, as it would in sequence
+                routes[i] = route
+
+            solving_bar = progressbar.ProgressBar(sum(route is not None for route in routes), len(routes), "Solving routes: ", "(total: " + str(len(routes)) + ")")
+            solving_bar.print()
+    print()
+
+    return routes
+
+
+_worker = {}  # state of a pool worker, set by init_worker()
+
+
+def init_worker(network_file, tls, congestion, evaluation, silent = True):
+    _worker['silent'] = silent  # the training logs of every pair would interleave, see solve_group()
+    _worker.pop('goal_agent', None)  # its tables were learned in the env of an earlier call
+    _worker['env'] = environment.traffic_env(  # network.load() is inherited when forked, otherwise read from the disk cache
+        network_file = network_file,
+        tls = tls,
+        congestion = congestion,
+        evaluation = evaluation,
+    )
+
+
+def solve_group(od_pairs, num_episodes, threshold, warm_start = False, goal_conditioned = False, warm_radius = 0):
+    """
+    Returns:
+    - routes (list of (node_path, edge_path, episode)): what Q_Learning.train() returns but the logs, for every pair
+    """
+    if not _worker['silent']:
+        return train_group(od_pairs, num_episodes, threshold, warm_start, goal_conditioned, warm_radius)
+
+    # Only for the duration of the task, so the worker keeps its own stdout and no file is left open
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        return train_group(od_pairs, num_episodes, threshold, warm_start, goal_conditioned, warm_radius)
+
+
+def train_group(od_pairs, num_episodes, threshold, warm_start = False, goal_conditioned = False, warm_radius = 0):
+    if goal_conditioned:
+        if 'goal_agent' not in _worker:  # one for the worker, its tables are kept across groups
+            _worker['goal_agent'] = agent.Goal_Q_Learning(_worker['env'], potential = warm_start)
+        return [_worker['goal_agent'].route(start_node, end_node, num_episodes, threshold) for start_node, end_node in od_pairs]
+
+    q_cache = agent.QTableCache(radius = warm_radius) if warm_start else None
+    routes = []
+
+    for start_node, end_node in od_pairs:
+        QLearning_agent = agent.Q_Learning(_worker['env'], start_node, end_node)
+        QLearning_agent.set_warm_start(potential = warm_start, cache = q_cache)
+        node_path, edge_path, episode, _ = QLearning_agent.train(num_episodes, threshold)
+        routes.append((node_path, edge_path, episode))
+
+    return routes
@@ -0,0 +1,301 @@
+import sys
+import math
+import heapq
+import numpy as np
+
+try:
+    import pyproj  # only to take lon/lat, see NetworkLocator.lonlat_to_xy()
+except ImportError:
+    pyproj = None
+
+
+class GridIndex:
+    def __init__ (self, cell_size = 200):
+        """
+        Uniform grid over x-y coordinates for moving points, e.g. the positions of the idle vehicles
+
+        Args:
+        - cell_size (float): side of a cell, in the units of the coordinates (m)
+        """
+        self.cell_size = cell_size
+        self.cells = {}  # (i, j) -> set of items
+        self.positions = {}  # item -> (x, y)
+
+
+    def cell_of(self, x, y):
+        return (math.floor(x / self.cell_size), math.floor(y / self.cell_size))
+
+
+    def insert(self, item, x, y):
+        self.remove(item)
+        self.positions[item] = (x, y)
+        self.cells.setdefault(self.cell_of(x, y), set()).add(item)
+
+
+    def remove(self, item):
+        if item not in self.positions:
+            return
+        cell = self.cell_of(*self.positions.pop(item))
+        self.cells[cell].discard(item)
+        if not self.cells[cell]:
+            del self.cells[cell]
+
+
+    def __len__ (self):
+        return len(self.positions)
+
+
+    def __contains__ (self, item):
+        return item in self.positions
+
+
+    def nearest(self, x, y):
+        """
+        Walk the items from the nearest one to (x, y), ring of cells after ring of cells
+
+        Yields:
+        - (distance, item): by increasing straight line distance, ties by item
+        """
+        if not self.positions:
+            return
+
+        center_i, center_j = self.cell_of(x, y)
+        cells_i = [i for i, _ in self.cells]
+        cells_j = [j for _, j in self.cells]
+        max_ring = max(abs(min(cells_i) - center_i), abs(max(cells_i) - center_i), abs(min(cells_j) - center_j), abs(max(cells_j) - center_j))
+
+        found = []  # heap of (distance, item) found but not yielded yet
+        for ring in range(max_ring + 1):
+            for i in range(center_i - ring, center_i + ring + 1):
+                for j in range(center_j - ring, center_j + ring + 1):
+                    if max(abs(i - center_i), abs(j - center_j)) != ring or (i, j) not in self.cells:
+                        continue
+                    for item in self.cells[(i, j)]:
+                        item_x, item_y = self.positions[item]
+                        heapq.heappush(found, (math.hypot(item_x - x, item_y - y), item))
+
+            # anything in the rings further out is at least ring * cell_size away
+            while found and found[0][0] <= ring * self.cell_size:
+                yield heapq.heappop(found)
+
+        while found:
+            yield heapq.heappop(found)
+
+
+class SegmentIndex:
+    def __init__ (self, start, end, cell_size = None):
+        """
+        Static grid over fixed segments, e.g. the pieces of the edge shapes of a network, answering nearest
+        segment queries for whole arrays of query points at once. Like an R-tree, a segment is kept in every
+        cell its bounding box overlaps.
+
+        Args:
+        - start (np.ndarray[S, 2]), end (np.ndarray[S, 2]): x-y coordinates of the ends of every segment
+        - cell_size (float): side of a cell, defaults to about two segments per cell
+        """
+        self.start = np.asarray(start, dtype=np.float64).reshape(-1, 2)
+        self.end = np.asarray(end, dtype=np.float64).reshape(-1, 2)
+        if not len(self.start):
+            sys.exit('Error: Cannot index an empty set of segments')
+
+        low = np.minimum(self.start, self.end).min(axis=0)
+        high = np.maximum(self.start, self.end).max(axis=0)
+        if cell_size is None:
+            area = float(np.prod(np.maximum(high - low, 1.0)))  # points on a line still get cells of some width
+            cell_size = math.sqrt(area * 2 / len(self.start))
+        self.cell_size = cell_size
+        self.origin = low
+        self.shape = (np.floor((high - low) / cell_size).astype(np.int64) + 1).tolist()  # cells along x and y
+
+        # 1. Every (segment, cell) of the cells overlapped by the bounding box of the segment
+        first = np.floor((np.minimum(self.start, self.end) - low) / cell_size).astype(np.int64)
+        last = np.floor((np.maximum(self.start, self.end) - low) / cell_size).astype(np.int64)
+        span = last - first + 1
+        counts = span[:, 0] * span[:, 1]
+        segment = np.repeat(np.arange(len(self.start)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cell = (first[segment, 0] + local // span[segment, 1]) * self.shape[1] + first[segment, 1] + local % span[segment, 1]
+
+        # 2. CSR over the cells: the segments in cell c are order[cell_ptr[c]:cell_ptr[c+1]]
+        self.order = segment[np.argsort(cell, kind='stable')]
+        self.cell_ptr = np.concatenate(([0], np.cumsum(np.bincount(cell, minlength=self.shape[0] * self.shape[1]))))
+
+
+    def distance(self, segment, query):
+        """
+        Returns:
+        - distance (np.ndarray of float): from every query point to its segment
+        - t (np.ndarray of float): where the closest point is along the segment, 0 at start to 1 at end
+        """
+        start = self.start[segment]
+        dx, dy = (self.end[segment] - start).T
+        qx, qy = (query - start).T
+        length2 = dx * dx + dy * dy
+        t = np.clip(np.divide(qx * dx + qy * dy, length2, out=np.zeros(len(segment)), where=length2 > 0), 0, 1)
+        return np.hypot(qx - t * dx, qy - t * dy), t
+
+
+    def nearest(self, query):
+        """
+        Nearest segment of every query point. The block of cells around each query grows until the
+        closest segment found is nearer than anything outside the block could be.
+
+        Args:
+        - query (np.ndarray[Q, 2]): x-y coordinates
+
+        Returns:
+        - index (np.ndarray[Q] of int): the nearest segment
+        - distance (np.ndarray[Q] of float)
+        - t (np.ndarray[Q] of float): where the closest point is along it, see distance()
+        """
+        query = np.asarray(query, dtype=np.float64).reshape(-1, 2)
+        index = np.full(len(query), -1, dtype=np.int64)
+        distance = np.full(len(query), np.inf)
+        position = np.zeros(len(query))
+        shape = np.array(self.shape)
+        cell = np.clip(np.floor((query - self.origin) / self.cell_size).astype(np.int64), 0, shape - 1)  # the closest cell for a query off the grid
+
+        pending = np.arange(len(query))
+        scanned, radius = -1, 1
+        while len(pending):
+            q, c = query[pending], cell[pending]
+            best, best_distance, best_position = index[pending], distance[pending], position[pending]
+
+            # 1. Scan the cells of the ring (scanned, radius] around every query, as far as they fall in the grid
+            for di in range(-min(radius, self.shape[0] - 1), min(radius, self.shape[0] - 1) + 1):
+                for dj in range(-min(radius, self.shape[1] - 1), min(radius, self.shape[1] - 1) + 1):
+                    if max(abs(di), abs(dj)) <= scanned:
+                        continue
+                    ci, cj = c[:, 0] + di, c[:, 1] + dj
+                    inside = (ci >= 0) & (ci < self.shape[0]) & (cj >= 0) & (cj < self.shape[1])
+                    flat = np.where(inside, ci * self.shape[1] + cj, 0)
+                    start = self.cell_ptr[flat]
+                    count = np.where(inside, self.cell_ptr[flat + 1] - start, 0)
+                    if not count.any():
+                        continue
+
+                    # every (query, segment in its cell) pair at once, then the closest one of every query
+                    rows = np.repeat(np.arange(len(q)), count)
+                    local = np.arange(len(rows)) - np.repeat(np.cumsum(count) - count, count)
+                    candidate = self.order[start[rows] + local]
+                    candidate_distance, candidate_position = self.distance(candidate, q[rows])
+
+                    cell_best = np.full(len(q), np.inf)
+                    np.minimum.at(cell_best, rows, candidate_distance)
+                    better = (candidate_distance == cell_best[rows]) & (candidate_distance < best_distance[rows])
+                    best[rows[better]] = candidate[better]
+                    best_distance[rows[better]] = candidate_distance[better]
+                    best_position[rows[better]] = candidate_position[better]
+
+            index[pending], distance[pending], position[pending] = best, best_distance, best_position
+
+            # 2. Done when whatever lies beyond the sides of the block that still have cells beyond them cannot be closer
+            low = np.where(c - radius > 0, q - (self.origin + (c - radius) * self.cell_size), np.inf)
+            high = np.where(c + radius < shape - 1, self.origin + (c + radius + 1) * self.cell_size - q, np.inf)
+            margin = np.minimum(low, high).min(axis=1)
+            pending = pending[best_distance > margin]
+            scanned, radius = radius, radius * 2
+
+        return index, distance, position
+
+
+class PointIndex(SegmentIndex):
+    def __init__ (self, points, cell_size = None):
+        """
+        Static grid over fixed points, e.g. the nodes of a network, as segments of length 0
+
+        Args:
+        - points (np.ndarray[P, 2]): x-y coordinates
+        - cell_size (float): side of a cell, defaults to about two points per cell
+        """
+        super().__init__(points, points, cell_size)
+        self.points = self.start
+
+
+    def distance(self, segment, query):
+        return np.hypot(*(self.points[segment] - query).T), np.zeros(len(segment))
+
+
+    def nearest(self, query):
+        """
+        Returns:
+        - index (np.ndarray[Q] of int): row of the nearest point in points
+        - distance (np.ndarray[Q] of float)
+        """
+        index, distance, _ = super().nearest(query)
+        return index, distance
+
+
+class NetworkLocator:
+    def __init__ (self, network):
+        """
+        Map coordinates to the nodes and edges of a network, see CompiledNetwork.locator
+
+        Args:
+        - network (CompiledNetwork)
+        """
+        self.network = network
+        self.node_index = PointIndex(network.node_xy)
+
+        # every piece of every edge shape, with the length of the shape before it
+        shape_xy, shape_ptr = network.shape_xy, network.shape_ptr
+        is_start = np.ones(len(shape_xy), dtype=bool)  # points that start a segment, i.e. all but the last of each shape
+        is_start[shape_ptr[1:] - 1] = False
+        self.segment_edge = np.repeat(np.arange(len(network.edges)), np.diff(shape_ptr) - 1)
+        start, end = shape_xy[:-1][is_start[:-1]], shape_xy[1:][is_start[:-1]]
+        self.segment_length = np.hypot(*(end - start).T)
+        before = np.cumsum(self.segment_length) - self.segment_length
+        self.segment_offset = before - before[np.searchsorted(self.segment_edge, self.segment_edge)]  # restart at every edge
+        self.edge_index = SegmentIndex(start, end)
+
+        self.projection = None  # pyproj.Proj of the network, built on the first lon/lat
+
+
+    def nearest_nodes(self, x, y, lonlat = False):
+        """
+        Args:
+        - x (np.ndarray of float), y (np.ndarray of float): coordinates of the network, or lon/lat if lonlat
+        - lonlat (bool)
+
+        Returns:
+        - node (np.ndarray of int): index of the nearest node of every point
+        - distance (np.ndarray of float): in m
+        """
+        if lonlat:
+            x, y = self.lonlat_to_xy(x, y)
+        return self.node_index.nearest(np.column_stack((np.ravel(x), np.ravel(y))))
+
+
+    def nearest_edges(self, x, y, lonlat = False):
+        """
+        Args:
+        - x (np.ndarray of float), y (np.ndarray of float): coordinates of the network, or lon/lat if lonlat
+        - lonlat (bool)
+
+        Returns:
+        - edge (np.ndarray of int): index of the nearest edge of every point, by its shape
+        - distance (np.ndarray of float): in m
+        - position (np.ndarray of float): where the closest point is along the shape of the edge, in m from its start
+        """
+        if lonlat:
+            x, y = self.lonlat_to_xy(x, y)
+        segment, distance, t = self.edge_index.nearest(np.column_stack((np.ravel(x), np.ravel(y))))
+        return self.segment_edge[segment], distance, self.segment_offset[segment] + t * self.segment_length[segment]
+
+
+    def lonlat_to_xy(self, lon, lat):
+        """
+        Project lon/lat to the coordinates of the network, like sumolib's convertLonLat2XY(), with pyproj
+
+        Returns:
+        - x (np.ndarray of float), y (np.ndarray of float)
+        """
+        if pyproj is None:
+            sys.exit('Error: pyproj is needed to use lon/lat, install it or give coordinates of the network')
+        if not self.network.proj_parameter or self.network.proj_parameter == '!':
+            sys.exit(f'Error: {self.network.network_file} has no geo projection')
+
+        if self.projection is None:
+            self.projection = pyproj.Proj(self.network.proj_parameter)
+        x, y = self.projection(np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+        return np.asarray(x) + self.network.net_offset[0], np.asarray(y) + self.network.net_offset[1]
@@ -0,0 +1,197 @@
+import sys
+import numpy as np
+import xml.etree.ElementTree as ET
+
+from utilities import filecache
+
+
+def load_tls(file_name):
+    """
+    Make tls data from tll.xml, the parsed programs are cached on disk next to the file
+    and reused for as long as its content does not change
+
+    Args:
+    - file_name: tll.xml file name
+
+    Returns:
+    - tls_data (TrafficLights): tls_data[tl_id][link_index][t] is the state of the link at second t of the cycle
+    """
+    arrays = filecache.load(file_name, 'tll')
+    if arrays is None:
+        arrays = parse_tllxml(file_name)
+        filecache.save(file_name, 'tll', arrays)
+
+    return TrafficLights(arrays)
+
+
+def parse_tllxml(file_name):
+    """
+    Stream every <tlLogic> and its <phase> out of a tll.xml (or net.xml) file,
+    clearing the elements once read so that large files are not held in memory
+
+    Args:
+    - file_name: tll.xml file name
+
+    Returns:
+    - arrays (dict):
+        tl_ids[T]
+        phase_ptr[T+1]: the phases of tl t are phase_duration/phase_state[phase_ptr[t]:phase_ptr[t+1]]
+        phase_duration[P] (int)
+        phase_state[P] (str)
+    """
+    tl_ids = []
+    phase_ptr = [0]
+    phase_duration = []
+    phase_state = []
+
+    depth = 0  # of the element, the root being 0
+    in_tl = False
+
+    for event, element in ET.iterparse(file_name, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if element.tag == 'tlLogic':
+                in_tl = True
+            continue
+
+        depth -= 1
+        if element.tag == 'phase' and in_tl and element.get('state') is not None:  # a bare <phase/> has nothing to add
+            phase_duration.append(int(element.get('duration')))  # find the duration=""
+            phase_state.append(element.get('state'))  # find the state=""
+        elif element.tag == 'tlLogic':
+            tl_ids.append(element.get('id'))  # find the id=""
+            phase_ptr.append(len(phase_duration))
+            in_tl = False
+
+        if depth == 1:  # a child of the root is done with
+            element.clear()
+
+    return {
+        'tl_ids': np.array(tl_ids, dtype=str),
+        'phase_ptr': np.array(phase_ptr, dtype=np.int32),
+        'phase_duration': np.array(phase_duration, dtype=np.int32),
+        'phase_state': np.array(phase_state, dtype=str),
+    }
+
+
+class TrafficLights:
+    def __init__ (self, arrays):
+        """
+        Programs of every traffic light, read like the dict tls_data[tl_id][link_index] it replaces
+
+        Args:
+        - arrays (dict): output of parse_tllxml()
+        """
+        tl_ids = arrays['tl_ids'].tolist()
+        phase_ptr = arrays['phase_ptr'].tolist()
+
+        self.programs = {}
+        for i, tl_id in enumerate(tl_ids):
+            if tl_id in self.programs:
+                sys.exit(f"Error: {tl_id} duplicated")
+            phases = slice(phase_ptr[i], phase_ptr[i+1])
+            self.programs[tl_id] = Program(arrays['phase_duration'][phases], arrays['phase_state'][phases].tolist())
+
+
+    def __getitem__ (self, tl_id):
+        return self.programs[tl_id]
+
+
+    def __contains__ (self, tl_id):
+        return tl_id in self.programs
+
+
+    def __len__ (self):
+        return len(self.programs)
+
+
+    def __iter__ (self):
+        return iter(self.programs)
+
+
+    def keys (self):
+        return self.programs.keys()
+
+
+    def values (self):
+        return self.programs.values()
+
+
+    def items (self):
+        return self.programs.items()
+
+
+class Program:
+    def __init__ (self, phase_duration, phase_state):
+        """
+        The program of one traffic light as a (num_links, cycle_length) uint8 matrix of state characters
+
+        Args:
+        - phase_duration (np.ndarray[P] of int): seconds of every phase
+        - phase_state (list[P] of str): state of every link in every phase, e.g. "GGgrrr"
+        A <tlLogic> without phases gets no links and a cycle of 0 seconds, i.e. it never makes anyone wait
+        """
+        num_links = max((len(state) for state in phase_state), default=0)
+        self.phase_end = np.cumsum(phase_duration)  # phase boundaries, in seconds from the start of the cycle
+        self.cycle_length = int(self.phase_end[-1]) if len(self.phase_end) else 0
+
+        # the states of a phase missing some links leave them off ("O")
+        phase_matrix = np.array([list(state.ljust(num_links, 'O').encode('ascii')) for state in phase_state], dtype=np.uint8).reshape(len(phase_state), num_links)
+        self.states = np.repeat(phase_matrix, phase_duration, axis=0).T.copy()  # [link][second]
+        self.links = {}  # link_index -> str of the states, decoded on first use
+
+
+    def __getitem__ (self, link_index):
+        """
+        Returns:
+        - states (str): one state character per second of the cycle, indexed like the old per-second list
+        """
+        if link_index not in self.links:
+            if not 0 <= link_index < len(self.states):
+                raise KeyError(link_index)
+            self.links[link_index] = self.states[link_index].tobytes().decode('ascii')
+        return self.links[link_index]
+
+
+    def __contains__ (self, link_index):
+        return 0 <= link_index < len(self.states)
+
+
+    def __len__ (self):
+        return len(self.states)
+
+
+    def __iter__ (self):
+        return iter(range(len(self.states)))
+
+
+    def keys (self):
+        return range(len(self.states))
+
+
+    def items (self):
+        return [(link_index, self[link_index]) for link_index in range(len(self.states))]
+
+
+def wait_table(link_states):
+    """
+    Seconds to wait at a link arriving at every second of its cycle, 0 unless it is red ("r")
+
+    Args:
+    - link_states (list of str): tls_data[tl_id][link_index], one state per second of the cycle
+
+    Returns:
+    - wait (list[cycle_length] of int): wait[t % cycle_length] for an arrival at time t,
+        0 as well if the link is never green, empty for a cycle of 0 seconds, which means no wait
+    """
+    is_red = np.array([state == "r" for state in link_states], dtype=bool)
+    cycle_length = len(is_red)
+    go = np.flatnonzero(~is_red)
+    if not go.size:
+        return [0] * cycle_length
+
+    # the first second at or after t that is not red, looking into the next cycle as well
+    go = np.concatenate([go, go + cycle_length])
+    seconds = np.arange(cycle_length)
+    wait = go[np.searchsorted(go, seconds)] - seconds
+    return wait.tolist()
@@ -0,0 +1,116 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from models import dijkstra
+from models import network
+from utilities import filecache
+
+
+def weights_key(evaluation, weights):
+    """
+    Cache key of a table, it changes with the evaluation and with any change of the edge weights (e.g. congestion)
+    """
+    return f'{evaluation}:{filecache.array_digest(weights)}'
+
+
+def load(env, build = True, processes = None):
+    """
+    Load the all-pairs table of env from the cache, building it if it is missing or stale
+
+    Args:
+    - env (environment.traffic_env): the table is made for env.network and env.get_edge_weights()
+    - build (bool): False to only load an existing table
+    - processes (int): worker processes used to build it, defaults to the number of cores
+
+    Returns:
+    - table (TravelTable), or None if there is none and build is False
+    """
+    weights = env.get_edge_weights()
+    key = weights_key(env.evaluation, weights)
+
+    arrays = filecache.load_mmap(env.network_file, 'table', ['cost', 'predecessor_edge'], key)
+    if arrays is None or arrays['cost'].shape != (len(env.nodes), len(env.nodes)):
+        if not build:
+            return None
+        arrays = build_table(env.network_file, weights, key, processes)
+
+    return TravelTable(env.network, env.evaluation, arrays['cost'], arrays['predecessor_edge'])
+
+
+def build_table(network_file, weights, key, processes = None):
+    """
+    Run a full Dijkstra from every node, the sources are split over a process pool
+
+    Returns:
+    - arrays (dict): cost[N, N] (float64) and predecessor_edge[N, N] (int32), memory-mapped when the cache is writable
+    """
+    num_nodes = len(network.load(network_file).nodes)
+    temp_path, arrays = filecache.create_mmap(network_file, 'table', {
+        'cost': ((num_nodes, num_nodes), np.float64),
+        'predecessor_edge': ((num_nodes, num_nodes), np.int32),
+    }, key)
+
+    processes = processes or os.cpu_count() or 1
+    chunks = [range(start, min(start + 64, num_nodes)) for start in range(0, num_nodes, 64)]
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=init_worker, initargs=(network_file, weights)) as executor:
+        for sources, cost, predecessor_edge in executor.map(search_rows, chunks):
+            arrays['cost'][sources.start:sources.stop] = cost
+            arrays['predecessor_edge'][sources.start:sources.stop] = predecessor_edge
+
+    return filecache.commit_mmap(network_file, 'table', temp_path, arrays, key)
+
+
+_worker = {}  # state of a pool worker, set by init_worker()
+
+
+def init_worker(network_file, weights):
+    _worker['network'] = network.load(network_file)  # inherited when forked, otherwise read from the disk cache
+    _worker['weights'] = weights
+
+
+def search_rows(sources):
+    """
+    Shortest path trees of a chunk of sources, run in a pool worker
+
+    Returns:
+    - sources (range), cost (np.ndarray[len(sources), N]), predecessor_edge (np.ndarray[len(sources), N])
+    """
+    rows = [dijkstra.shortest_path_tree(_worker['network'], _worker['weights'], source)[:2] for source in sources]
+    cost = np.array([row[0] for row in rows], dtype=np.float64)
+    predecessor_edge = np.array([row[1] for row in rows], dtype=np.int32)
+    return sources, cost, predecessor_edge
+
+
+class TravelTable:
+    def __init__ (self, network, evaluation, cost, predecessor_edge):
+        """
+        All-pairs shortest costs of one (network, edge weights) pair
+
+        Args:
+        - network (CompiledNetwork)
+        - evaluation (str): "time" or "distance", what cost holds
+        - cost (np.ndarray[N, N]): cost[s][t] from node s to node t, inf if unreachable
+        - predecessor_edge (np.ndarray[N, N]): predecessor_edge[s][t] is the last edge of the path s -> t, -1 if none
+        """
+        self.network = network
+        self.evaluation = evaluation
+        self.cost = cost
+        self.predecessor_edge = predecessor_edge
+
+
+    def lookup(self, source, target):
+        """
+        Returns:
+        - cost (float) from node index source to node index target
+        """
+        return float(self.cost[source, target])
+
+
+    def path(self, source, target):
+        """
+        Returns:
+        - node_path (list of node index), edge_path (list of edge index), in O(path length)
+        """
+        return dijkstra.trace_path(self.network, self.predecessor_edge[source], target)
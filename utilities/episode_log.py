@@ -0,0 +1,168 @@
+import sys
+import numpy as np
+
+
+class EpisodeLog:
+    def __init__ (self, state_space, edges, retention = "all", size = 10, callback = None):
+        """
+        Routes taken in the episodes of a training run, kept as integer ids back to back in one buffer.
+        It reads like the old dict: logs[episode] = [node_path, edge_path] with IDs.
+
+        Args:
+        - state_space (list of str), edges (list of str): to translate the ids back to IDs
+        - retention (str): which episodes to keep, the latest one is always kept
+            - "all": every episode
+            - "last": the last `size` episodes
+            - "best": the `size` fastest episodes that reached the end node
+            - "every": one episode every `size` episodes
+        - size (int): the k of the retention
+        - callback (function): called as callback(episode, node_path, edge_path, cost) on every episode,
+            with paths of ids, whether it is kept or not
+        """
+        if retention not in ("all", "last", "best", "every"):
+            sys.exit(f'Error: Invalid log retention {retention}')
+        if size < 1:
+            sys.exit(f'Error: Invalid log size {size}')
+
+        self.state_space = state_space
+        self.edges = edges
+        self.retention = retention
+        self.size = size
+        self.callback = callback
+
+        self.buffer = np.empty(1024, dtype=np.int32)  # node ids then edge ids of every kept episode
+        self.used = 0  # length of the buffer written so far
+        self.entries = {}  # episode -> (offset, num_nodes, num_edges, cost, is_complete), in episode order
+        self.latest = -1
+
+
+    def append(self, episode, node_path, edge_path, cost, is_complete):
+        """
+        Args:
+        - episode (int)
+        - node_path (list of state id), edge_path (list of edge id)
+        - cost (float): time taken by the route
+        - is_complete (bool): whether the route reached the end node
+        """
+        if self.callback:
+            self.callback(episode, node_path, edge_path, cost)
+
+        length = len(node_path) + len(edge_path)
+        self.reserve(length)
+        self.buffer[self.used:self.used+len(node_path)] = node_path
+        self.buffer[self.used+len(node_path):self.used+length] = edge_path
+        self.entries[episode] = (self.used, len(node_path), len(edge_path), cost, is_complete)
+        self.used += length
+
+        previous, self.latest = self.latest, episode
+        self.evict(previous)
+
+
+    def evict(self, previous):
+        """
+        Apply the retention once a new episode came in, previous is the episode that was the latest before it
+        """
+        if self.retention == "last":
+            while len(self.entries) > self.size:
+                del self.entries[next(iter(self.entries))]
+
+        elif self.retention == "every":
+            if previous >= 0 and previous % self.size:
+                del self.entries[previous]
+
+        elif self.retention == "best" and previous >= 0:
+            if not self.entries[previous][4]:
+                del self.entries[previous]
+                return
+
+            ranked = [episode for episode in self.entries if episode != self.latest]
+            if len(ranked) > self.size:
+                worst = max(ranked, key=lambda episode: (self.entries[episode][3], episode))
+                del self.entries[worst]
+
+
+    def reserve(self, length):
+        """
+        Make room for length more ids, moving the kept episodes to the front of the buffer first
+        and doubling it only if they still take more than half of it
+        """
+        if self.used + length <= len(self.buffer):
+            return
+
+        live = sum(num_nodes + num_edges for _, num_nodes, num_edges, _, _ in self.entries.values())
+        capacity = len(self.buffer)
+        while live + length > capacity // 2:
+            capacity *= 2
+
+        buffer = np.empty(capacity, dtype=np.int32)
+        offset = 0
+        for episode, (start, num_nodes, num_edges, cost, is_complete) in self.entries.items():
+            buffer[offset:offset+num_nodes+num_edges] = self.buffer[start:start+num_nodes+num_edges]
+            self.entries[episode] = (offset, num_nodes, num_edges, cost, is_complete)
+            offset += num_nodes + num_edges
+        self.buffer, self.used = buffer, offset
+
+
+    def path_ids(self, episode):
+        """
+        Returns:
+        - node_path (list of state id), edge_path (list of edge id)
+        """
+        start, num_nodes, num_edges, _, _ = self.entries[episode]
+        return self.buffer[start:start+num_nodes].tolist(), self.buffer[start+num_nodes:start+num_nodes+num_edges].tolist()
+
+
+    def edge_paths(self, episodes):
+        """
+        The edge paths of many episodes back to back, for traffic_env.get_route_costs()
+
+        Returns:
+        - edge_ids (np.ndarray of int), offsets (np.ndarray[len(episodes)+1] of int): episodes[k] took edge_ids[offsets[k]:offsets[k+1]]
+        """
+        entries = [self.entries[episode] for episode in episodes]
+        lengths = np.array([num_edges for _, _, num_edges, _, _ in entries], dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        if not len(entries):
+            return np.empty(0, dtype=np.int64), offsets
+        first = np.array([start + num_nodes for start, num_nodes, _, _, _ in entries], dtype=np.int64)
+        edge_ids = self.buffer[np.repeat(first - offsets[:-1], lengths) + np.arange(offsets[-1])]
+        return edge_ids.astype(np.int64), offsets
+
+
+    def cost(self, episode):
+        return self.entries[episode][3]
+
+
+    def is_complete(self, episode):
+        return self.entries[episode][4]
+
+
+    # ----- Read like a dict of episode -> [node_path, edge_path]
+
+    def __getitem__ (self, episode):
+        node_path, edge_path = self.path_ids(episode)
+        return [[self.state_space[state] for state in node_path], [self.edges[edge] for edge in edge_path]]
+
+
+    def __contains__ (self, episode):
+        return episode in self.entries
+
+
+    def __len__ (self):
+        return len(self.entries)
+
+
+    def __iter__ (self):
+        return iter(list(self.entries))
+
+
+    def keys (self):
+        return list(self.entries)
+
+
+    def values (self):
+        return [self[episode] for episode in self.entries]
+
+
+    def items (self):
+        return [(episode, self[episode]) for episode in self.entries]
@@ -0,0 +1,223 @@
+import os
+import shutil
+import hashlib
+import numpy as np
+
+
+CACHE_DIR = '__netcache__'  # created next to the source file, like __pycache__
+CACHE_VERSION = '2'  # bump when the layout of any cached arrays changes
+MAX_ENTRIES = 8  # entries kept per source file and tag, e.g. travel tables of different congestions, least recently used dropped first
+
+_digests = {}  # (abspath, size, mtime) -> sha1 of the content
+
+
+def file_digest(file_name):
+    """
+    Content hash of a file, memoised on its size and modification time
+
+    Args:
+    - file_name (str)
+
+    Returns:
+    - digest (str): sha1 hex digest
+    """
+    path = os.path.abspath(file_name)
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+
+    if key not in _digests:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+        _digests[key] = sha1.hexdigest()
+
+    return _digests[key]
+
+
+def array_digest(values):
+    """
+    Content hash of a list or array of floats, e.g. edge weights
+
+    Returns:
+    - digest (str): sha1 hex digest
+    """
+    return hashlib.sha1(np.asarray(values, dtype=np.float64).tobytes()).hexdigest()
+
+
+def cache_path(source_file, tag, key = '', suffix = '.npz'):
+    """
+    Where the arrays derived from source_file are cached
+
+    Args:
+    - source_file (str): the file the arrays are derived from
+    - tag (str): what kind of arrays, e.g. 'net' or 'tll'
+    - key (str): anything else the arrays depend on, e.g. congestion or evaluation
+    - suffix (str): '.npz' for a single file, '' for a directory of .npy files
+
+    Returns:
+    - path (str): __netcache__/<basename>.<tag>.<source digest>.<digest><suffix>, the source digest only
+        depends on the content of source_file, so that remove_stale() tells the entries of an older file apart
+    """
+    source = source_digest(source_file)
+    digest = hashlib.sha1('|'.join([CACHE_VERSION, file_digest(source_file), key]).encode()).hexdigest()[:16]
+    directory = os.path.join(os.path.dirname(os.path.abspath(source_file)), CACHE_DIR)
+    return os.path.join(directory, f'{os.path.basename(source_file)}.{tag}.{source}.{digest}{suffix}')
+
+
+def source_digest(source_file):
+    return hashlib.sha1('|'.join([CACHE_VERSION, file_digest(source_file)]).encode()).hexdigest()[:8]
+
+
+def load(source_file, tag, key = ''):
+    """
+    Load cached arrays, they are stale as soon as source_file (or key) changes
+
+    Returns:
+    - arrays (dict): name -> np.ndarray, or None if there is no valid cache
+    """
+    path = cache_path(source_file, tag, key)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            arrays = {name: data[name] for name in data.files}
+    except (OSError, ValueError):  # truncated or corrupted, it will simply be rebuilt
+        return None
+
+    touch(path)
+    return arrays
+
+
+def save(source_file, tag, arrays, key = ''):
+    """
+    Cache arrays for source_file and remove the stale ones of the same tag, see remove_stale()
+    A read-only directory only means that nothing is cached.
+
+    Args:
+    - arrays (dict): name -> np.ndarray, no object arrays
+    """
+    path = cache_path(source_file, tag, key)
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(temp_path, path)  # atomic, readers never see a half written file
+        remove_stale(source_file, tag, path)
+    except OSError:
+        pass
+
+
+def load_mmap(source_file, tag, names, key = ''):
+    """
+    Memory-map cached arrays that are too big to be read eagerly, see create_mmap()
+
+    Args:
+    - names (list of str): the arrays expected in the cache
+
+    Returns:
+    - arrays (dict): name -> read-only np.memmap, or None if there is no valid cache
+    """
+    path = cache_path(source_file, tag, key, suffix = '')
+    if not os.path.isdir(path):
+        return None
+
+    try:
+        arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in names}
+    except (OSError, ValueError):
+        return None
+
+    touch(path)
+    return arrays
+
+
+def create_mmap(source_file, tag, shapes, key = ''):
+    """
+    Create writable memory-mapped arrays in a temporary directory, fill them, then commit_mmap()
+
+    Args:
+    - shapes (dict): name -> (shape, dtype)
+
+    Returns:
+    - temp_path (str): to be passed to commit_mmap(), None if the cache directory is not writable
+    - arrays (dict): name -> np.memmap, backed by an anonymous buffer when temp_path is None
+    """
+    path = cache_path(source_file, tag, key, suffix = '')
+    temp_path = f'{path}.{os.getpid()}.tmp'
+
+    try:
+        os.makedirs(temp_path, exist_ok=True)
+        arrays = {
+            name: np.lib.format.open_memmap(os.path.join(temp_path, f'{name}.npy'), mode='w+', dtype=dtype, shape=shape)
+            for name, (shape, dtype) in shapes.items()
+        }
+        return temp_path, arrays
+    except OSError:
+        return None, {name: np.empty(shape, dtype=dtype) for name, (shape, dtype) in shapes.items()}
+
+
+def commit_mmap(source_file, tag, temp_path, arrays, key = ''):
+    """
+    Flush the arrays of create_mmap() and move them where load_mmap() finds them
+
+    Returns:
+    - arrays (dict): name -> read-only np.memmap of the committed cache, or the given arrays if it could not be written
+    """
+    if temp_path is None:
+        return arrays
+
+    path = cache_path(source_file, tag, key, suffix = '')
+    try:
+        for array in arrays.values():
+            array.flush()
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(temp_path, path)
+        remove_stale(source_file, tag, path)
+    except OSError:
+        return arrays
+
+    return load_mmap(source_file, tag, list(arrays), key) or arrays
+
+
+def touch(path):
+    """
+    Mark a cache entry as just used, remove_stale() drops the least recently used ones first
+    """
+    try:
+        os.utime(path)
+    except OSError:  # read-only, it is only evicted earlier
+        pass
+
+
+def remove_stale(source_file, tag, path):
+    """
+    Remove the cache entries of tag derived from another version of source_file, and the least recently
+    used ones beyond MAX_ENTRIES of this version. Entries of other keys (e.g. another congestion or
+    evaluation) of the same file are kept, so switching between them does not rebuild anything.
+    """
+    directory = os.path.dirname(path)
+    prefix = f'{os.path.basename(source_file)}.{tag}.'
+    current = f'{prefix}{source_digest(source_file)}.'
+
+    kept = []
+    for file_name in os.listdir(directory):
+        if not file_name.startswith(prefix) or file_name == os.path.basename(path) or file_name.endswith('.tmp'):
+            continue
+        if file_name.startswith(current):
+            kept.append(file_name)
+        else:
+            remove_entry(os.path.join(directory, file_name))
+
+    kept.sort(key=lambda file_name: os.path.getmtime(os.path.join(directory, file_name)))
+    for file_name in kept[:max(len(kept) - (MAX_ENTRIES - 1), 0)]:  # path itself is the most recent one
+        remove_entry(os.path.join(directory, file_name))
+
+
+def remove_entry(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)